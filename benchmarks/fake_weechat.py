@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+from typing import Dict
+
+from weechat_icat.shared import shared
+
+# An in-process replacement for the weechat module, with just enough of the
+# API for running the script outside of WeeChat. Processes are run
+# synchronously, so the whole flow of creating an image happens in the call.
+
+
+WEECHAT_RC_OK = 0
+WEECHAT_RC_OK_EAT = 1
+WEECHAT_RC_ERROR = -1
+WEECHAT_HOOK_PROCESS_RUNNING = -1
+WEECHAT_HOOK_PROCESS_ERROR = -2
+
+home_dir = tempfile.mkdtemp(prefix="icat-benchmark-")
+config: Dict[str, str] = {}
+
+
+def install():
+    # The modules of the script import weechat, so this has to be done before
+    # importing them
+    sys.modules["weechat"] = sys.modules[__name__]
+
+
+def get_callback(name: str):
+    return shared.weechat_callbacks[name]
+
+
+def register(*args: str) -> int:
+    return 1
+
+
+def string_eval_path_home(
+    path: str,
+    pointers: Dict[str, str],
+    extra_vars: Dict[str, str],
+    options: Dict[str, str],
+) -> str:
+    return path.replace("${weechat_cache_dir}", home_dir)
+
+
+def string_eval_expression(
+    expr: str,
+    pointers: Dict[str, str],
+    extra_vars: Dict[str, str],
+    options: Dict[str, str],
+) -> str:
+    return string_eval_path_home(expr, pointers, extra_vars, options)
+
+
+def mkdir_home(directory: str, mode: int) -> int:
+    os.makedirs(string_eval_path_home(directory, {}, {}, {}), mode, exist_ok=True)
+    return 1
+
+
+def config_get_plugin(option_name: str) -> str:
+    return config.get(option_name, "")
+
+
+def config_is_set_plugin(option_name: str) -> int:
+    return int(option_name in config)
+
+
+def config_set_plugin(option_name: str, value: str) -> int:
+    config[option_name] = value
+    return 1
+
+
+def config_set_desc_plugin(option_name: str, description: str) -> int:
+    return 1
+
+
+def config_string_to_boolean(text: str) -> int:
+    return int(text in ("on", "yes", "y", "true", "t", "1"))
+
+
+def prefix(prefix: str) -> str:
+    return ""
+
+
+def color(color_name: str) -> str:
+    # Similar to the codes WeeChat uses, so the strings have a similar length
+    return f"\x19F@{color_name:0>5}"
+
+
+def prnt(buffer: str, message: str) -> int:
+    return 1
+
+
+def command(buffer: str, command: str) -> int:
+    return WEECHAT_RC_OK
+
+
+def buffer_match_list(buffer: str, string: str) -> int:
+    return 1
+
+
+def hook_process(command: str, timeout: int, callback: str, callback_data: str) -> str:
+    function_name = command[len("func:") :]
+    try:
+        out, err, return_code = get_callback(function_name)(callback_data), "", 0
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        out, err, return_code = "", repr(e), 1
+    get_callback(callback)(callback_data, command, return_code, out, err)
+    return ""
+
+
+def hook_command(*args: str) -> str:
+    return ""
+
+
+def hook_fd(*args: object) -> str:
+    return ""
+
+
+def hook_print(*args: object) -> str:
+    return ""
+
+
+def hook_signal(*args: str) -> str:
+    return ""
+
+
+def hook_timer(*args: object) -> str:
+    return ""
+
+
+def unhook(hook: str):
+    pass
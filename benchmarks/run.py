@@ -0,0 +1,404 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union, cast
+
+from benchmarks import fake_weechat
+
+fake_weechat.install()
+
+# pylint: disable=wrong-import-position,wrong-import-order
+import PIL
+from PIL import Image
+
+from weechat_icat import commands, terminal_graphics
+from weechat_icat.config import init_config
+from weechat_icat.image import load_image_data
+from weechat_icat.placements import unregister_image_placements
+from weechat_icat.register import create_cache_paths
+from weechat_icat.shared import shared
+from weechat_icat.terminal_info import terminal_info
+
+# pylint: enable=wrong-import-position,wrong-import-order
+
+IMAGE_SIZES = {
+    "small": (64, 64),
+    "medium": (800, 600),
+    "large": (1920, 1080),
+}
+IMAGE_FORMATS = {
+    "png": "png",
+    "jpeg": "jpg",
+    "gif": "gif",
+    "webp": "webp",
+}
+# Maximum median time in seconds for loading the script, which main exits
+# with an error if exceeded. Loading should only define the functions and
+# classes, while heavy imports like Pillow are done when first needed.
+SCRIPT_LOAD_BUDGET = 0.12
+SCRIPT_LOAD_CODE = """
+import runpy, shutil, sys, time
+from benchmarks import fake_weechat
+fake_weechat.install()
+start = time.perf_counter()
+# Not run as __main__, since registering needs a terminal
+runpy.run_path(sys.argv[1], run_name="icat")
+print(time.perf_counter() - start)
+shutil.rmtree(fake_weechat.home_dir)
+"""
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    params: Dict[str, Any]
+    # Seconds per call
+    min: float
+    median: float
+    mean: float
+    repeat: int
+    number: int
+
+
+@dataclass
+class Benchmark:
+    name: str
+    params: Dict[str, Any]
+    function: Callable[[], object]
+    # Called before each call of function, outside of the timing
+    setup: Optional[Callable[[], object]] = None
+    # If set, function does its own timing and returns the seconds it took
+    self_timed: bool = False
+
+
+def generate_image(directory: str, size_name: str, image_format: str):
+    # The mandelbrot set gives a deterministic image with both smooth areas
+    # and detail, which compresses more like a photo than a gradient does
+    size = IMAGE_SIZES[size_name]
+    red = Image.effect_mandelbrot(size, (-2.0, -1.2, 0.8, 1.2), 100)
+    green = Image.effect_mandelbrot(size, (-1.0, -0.5, 0.0, 0.5), 50)
+    blue = Image.effect_mandelbrot(size, (-0.8, -0.2, -0.6, 0.0), 200)
+    path = os.path.join(directory, f"{size_name}.{IMAGE_FORMATS[image_format]}")
+    with Image.merge("RGB", (red, green, blue)) as im:
+        im.save(path)
+    return path
+
+
+def open_null_tty():
+    return open(  # pylint: disable=consider-using-with
+        os.devnull, "wb", buffering=terminal_graphics.TTY_BUFFER_SIZE
+    )
+
+
+def init_script():
+    shared.weechat_callbacks = {}
+    init_config()
+    create_cache_paths()
+    # Benchmark the work itself, not the caches, unless a benchmark enables them
+    fake_weechat.config["payload_cache_max_size"] = "0"
+    fake_weechat.config["thumbnail_cache_max_size"] = "0"
+    terminal_info.cell_width = 10
+    terminal_info.cell_height = 20
+    terminal_graphics.open_tty = open_null_tty
+
+
+def get_load_image_data_benchmarks(images: Dict[Tuple[str, str], str]):
+    for (size_name, image_format), path in images.items():
+        for max_size, transmission_format in [(None, "png"), ((200, 200), "raw")]:
+            yield Benchmark(
+                "load_image_data",
+                {
+                    "size": size_name,
+                    "format": image_format,
+                    "max_size": max_size,
+                    "transmission_format": transmission_format,
+                },
+                lambda path=path, max_size=max_size, fmt=transmission_format: (
+                    load_image_data(path, max_size, "lanczos", fmt, 1)
+                ),
+            )
+
+
+def get_write_chunked_benchmarks():
+    for size in [64 * 1024, 1024 * 1024, 16 * 1024 * 1024]:
+        data = os.urandom(size)
+        control_data: Dict[str, Union[str, int]] = {"a": "T", "q": 2, "f": 100, "i": 1}
+        yield Benchmark(
+            "write_chunked",
+            {"bytes": size},
+            lambda data=data: terminal_graphics.write_chunked(control_data, data),
+        )
+
+
+def get_display_image_benchmarks():
+    for rows, columns in [(5, 10), (20, 80)]:
+        image_placement = terminal_graphics.ImagePlacement("", 1, columns, rows)
+        for cached in [True, False]:
+            yield Benchmark(
+                "display_image",
+                {"rows": rows, "columns": columns, "cached": cached},
+                lambda image_placement=image_placement: terminal_graphics.display_image(
+                    "", image_placement
+                ),
+                None if cached else terminal_graphics.get_placeholder_lines.cache_clear,
+            )
+
+
+def get_parse_options_benchmarks():
+    supported_options = {
+        "columns": True,
+        "rows": True,
+        "print_immediately": False,
+        "restore": False,
+        "quiet": False,
+    }
+    for args in [
+        "-restore -quiet",
+        "-columns 10 -rows 5 ~/images/image.png",
+        "-print_immediately -columns 40 -rows 20 https://example.com/a/long/path/to/an/image%20with%20spaces.png",
+    ]:
+        yield Benchmark(
+            "parse_options",
+            {"args": args},
+            lambda args=args: commands.parse_options(args, supported_options),
+        )
+
+
+def get_create_image_benchmarks(images: Dict[Tuple[str, str], str]):
+    for size_name in ["medium", "large"]:
+        for image_format in ["png", "jpeg"]:
+            path = images[(size_name, image_format)]
+            for downscale in ["off", "on"]:
+                yield Benchmark(
+                    "create_image",
+                    {"size": size_name, "format": image_format, "downscale": downscale},
+                    lambda path=path: commands.create_image(
+                        "", path, None, 10, False, False
+                    ),
+                    lambda path=path, downscale=downscale: (
+                        unregister_image_placements(path),
+                        fake_weechat.config.update(downscale=downscale),
+                    ),
+                )
+
+
+def get_repository_dir():
+    return os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def build_compiled_script(directory: str):
+    # Build in a copy, so the dist directory in the repository isn't touched
+    repository_dir = get_repository_dir()
+    for name in ["build.sh", "icat.py"]:
+        shutil.copy(os.path.join(repository_dir, name), directory)
+    shutil.copytree(
+        os.path.join(repository_dir, "weechat_icat"),
+        os.path.join(directory, "weechat_icat"),
+        ignore=shutil.ignore_patterns("__pycache__"),
+    )
+    subprocess.run(["bash", "build.sh"], cwd=directory, check=True)
+    return os.path.join(directory, "dist", "icat.py")
+
+
+def load_script(path: str):
+    # Load in a new process, so nothing is imported already
+    return float(
+        subprocess.run(
+            [sys.executable, "-c", SCRIPT_LOAD_CODE, path],
+            cwd=get_repository_dir(),
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+    )
+
+
+def get_script_load_benchmarks():
+    compiled_dir = os.path.join(fake_weechat.home_dir, "compiled")
+    os.mkdir(compiled_dir)
+    scripts = {
+        "package": os.path.join(get_repository_dir(), "icat.py"),
+        "compiled": build_compiled_script(compiled_dir),
+    }
+    for script, path in scripts.items():
+        yield Benchmark(
+            "script_load",
+            {"script": script},
+            lambda path=path: load_script(path),
+            self_timed=True,
+        )
+
+
+def run_benchmark(benchmark: Benchmark, repeat: int, min_time: float):
+    if benchmark.self_timed:
+        times = [cast(float, benchmark.function()) for _ in range(repeat)]
+        return BenchmarkResult(
+            benchmark.name,
+            benchmark.params,
+            min(times),
+            statistics.median(times),
+            statistics.mean(times),
+            repeat,
+            1,
+        )
+
+    # Calls which don't need a setup are repeated in a loop until they take
+    # at least min_time, so fast calls can be measured
+    number = 1
+    if benchmark.setup is None:
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                benchmark.function()
+            if time.perf_counter() - start >= min_time:
+                break
+            number *= 2
+
+    times: List[float] = []
+    for _ in range(repeat):
+        if benchmark.setup:
+            benchmark.setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            benchmark.function()
+        times.append((time.perf_counter() - start) / number)
+
+    return BenchmarkResult(
+        benchmark.name,
+        benchmark.params,
+        min(times),
+        statistics.median(times),
+        statistics.mean(times),
+        repeat,
+        number,
+    )
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=get_repository_dir(),
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_result_key(result: Dict[str, Any]):
+    return json.dumps([result["name"], result["params"]], sort_keys=True)
+
+
+def print_comparison(old_path: str, results: List[BenchmarkResult]):
+    with open(old_path, encoding="utf-8") as f:
+        old_results = {get_result_key(r): r for r in json.load(f)["results"]}
+    for result in results:
+        old_result = old_results.get(get_result_key(asdict(result)))
+        if old_result:
+            ratio = result.median / old_result["median"]
+            print(
+                f"{ratio:6.2f}x  {result.name} {json.dumps(result.params)}",
+                file=sys.stderr,
+            )
+
+
+def run_benchmarks(name_filter: Optional[str], repeat: int, min_time: float):
+    images_dir = os.path.join(fake_weechat.home_dir, "images")
+    os.mkdir(images_dir)
+    images = {
+        (size_name, image_format): generate_image(images_dir, size_name, image_format)
+        for size_name in IMAGE_SIZES
+        for image_format in IMAGE_FORMATS
+    }
+
+    benchmarks = [
+        *get_script_load_benchmarks(),
+        *get_load_image_data_benchmarks(images),
+        *get_write_chunked_benchmarks(),
+        *get_display_image_benchmarks(),
+        *get_parse_options_benchmarks(),
+        *get_create_image_benchmarks(images),
+    ]
+    return [
+        run_benchmark(benchmark, repeat, min_time)
+        for benchmark in benchmarks
+        if not name_filter or benchmark.name == name_filter
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the benchmarks and print the results as JSON"
+    )
+    parser.add_argument("-o", "--output", help="write the results to this file")
+    parser.add_argument("-k", "--filter", help="only run benchmarks with this name")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.05)
+    parser.add_argument(
+        "--compare",
+        help="print the ratio of the median times to those in this results file",
+    )
+    parser.add_argument(
+        "--script-load-budget",
+        type=float,
+        default=SCRIPT_LOAD_BUDGET,
+        help="exit with an error if loading the script takes longer than this "
+        "many seconds",
+    )
+    args = parser.parse_args()
+
+    init_script()
+    try:
+        results = run_benchmarks(args.filter, args.repeat, args.min_time)
+    finally:
+        shutil.rmtree(fake_weechat.home_dir)
+
+    output = {
+        "meta": {
+            "commit": get_git_commit(),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "time": time.time(),
+        },
+        "results": [asdict(result) for result in results],
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        print_comparison(args.compare, results)
+
+    over_budget = [
+        result
+        for result in results
+        if result.name == "script_load" and result.median > args.script_load_budget
+    ]
+    for result in over_budget:
+        print(
+            f"loading the {result.params['script']} script took "
+            f"{result.median * 1000:.0f}ms, which is over the budget of "
+            f"{args.script_load_budget * 1000:.0f}ms",
+            file=sys.stderr,
+        )
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
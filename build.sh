@@ -14,5 +14,7 @@ contents="$(cat weechat_icat/util.py weechat_icat/!(util).py icat.py | \
   echo
   echo "$contents" | grep '^from __future__' | sort -u
   echo "$contents" | grep -v '^from __future__' | grep -E '^(import|from)' | sort -u
-  echo "$contents" | grep -Ev '^(import|from)' | sed 's/^\( \+\)\(import\|from\).*/\1pass/'
+  # Imports in functions are kept, since those are only imported when needed,
+  # except for the modules of the script itself, which are all in this file
+  echo "$contents" | grep -Ev '^(import|from)' | sed 's/^\( \+\)from weechat_icat[. ].*/\1pass/'
 ) > dist/icat.py
@@ -0,0 +1,10 @@
+from benchmarks import fake_weechat
+
+# The modules of the script import weechat, so this has to be done before the
+# tests import them
+fake_weechat.install()
+
+from weechat_icat.shared import shared  # pylint: disable=wrong-import-position
+
+# Set by icat.py when the script is loaded
+shared.weechat_callbacks = {}
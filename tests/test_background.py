@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import select
+from typing import Iterator, List, Tuple
+
+import pytest
+
+from benchmarks import fake_weechat
+from weechat_icat import background
+from weechat_icat.background import (
+    background_job,
+    render_worker_read_cb,
+    run_in_background,
+    stop_render_worker,
+)
+
+results: List[Tuple[str, int, str, str]] = []
+
+
+@background_job
+def job_a(data: str) -> str:
+    return f"a {data}"
+
+
+@background_job
+def job_b(data: str) -> str:
+    return f"b {data}"
+
+
+def job_finished_cb(data: str, command: str, return_code: int, out: str, err: str):
+    results.append((data, return_code, out, err))
+    return fake_weechat.WEECHAT_RC_OK
+
+
+@pytest.fixture(autouse=True)
+def render_worker_on(monkeypatch: pytest.MonkeyPatch) -> Iterator[None]:
+    monkeypatch.setitem(fake_weechat.config, "render_worker", "on")
+    results.clear()
+    yield
+    stop_render_worker()
+
+
+def wait_for_results(count: int):
+    # The fake weechat doesn't run fd hooks, so read the results here
+    while len(results) < count:
+        worker = background.render_worker
+        assert worker is not None
+        readable, _, _ = select.select([worker.result_fd], [], [], 10)
+        assert readable, "timed out waiting for the render worker"
+        render_worker_read_cb("", worker.result_fd)
+
+
+def test_jobs_registered_after_worker_started():
+    run_in_background(job_a, 10000, job_finished_cb, "1")
+    wait_for_results(1)
+    worker = background.render_worker
+
+    run_in_background(job_b, 10000, job_finished_cb, "2")
+    wait_for_results(2)
+
+    assert background.render_worker is worker
+    assert results == [("1", 0, "a 1", ""), ("2", 0, "b 2", "")]
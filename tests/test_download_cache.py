@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from benchmarks import fake_weechat
+from weechat_icat import download_cache
+from weechat_icat.download_cache import (
+    DownloadCacheEntry,
+    add_cached_download,
+    get_cached_download,
+    get_download_cache_path,
+    get_file_hash,
+    load_download_cache,
+    parse_download_cache_index,
+)
+
+HASH_A = "a" * 64
+HASH_B = "b" * 64
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(fake_weechat, "home_dir", str(tmp_path))
+    monkeypatch.setattr(
+        download_cache, "download_cache", download_cache.DownloadCache({}, {})
+    )
+    monkeypatch.setattr(download_cache, "download_cache_dir", "")
+    monkeypatch.setattr(download_cache, "file_hashes", {})
+    path = get_download_cache_path()
+    os.makedirs(path)
+    return path
+
+
+def test_parse_download_cache_index():
+    cache = parse_download_cache_index(
+        {
+            "urls": {"https://example.com/a.png": HASH_A},
+            "entries": {HASH_A: {"size": 10, "last_used": 1.5}},
+        }
+    )
+    assert cache.urls == {"https://example.com/a.png": HASH_A}
+    assert cache.entries == {HASH_A: DownloadCacheEntry(10, 1.5)}
+
+
+def test_parse_download_cache_index_drops_urls_without_entry():
+    cache = parse_download_cache_index(
+        {"urls": {"https://example.com/a.png": HASH_A}, "entries": {}}
+    )
+    assert not cache.urls
+
+
+@pytest.mark.parametrize(
+    "index",
+    [
+        {},
+        {"urls": {}, "entries": {HASH_A: {"size": 10}}},
+        {"urls": {}, "entries": {HASH_A: {"size": "large", "last_used": 1}}},
+        {"urls": [], "entries": {}},
+        [],
+    ],
+)
+def test_parse_download_cache_index_corrupt(index: object):
+    with pytest.raises((ValueError, KeyError, TypeError, AttributeError)):
+        parse_download_cache_index(index)
+
+
+def write_file(path: str, content: bytes):
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def test_load_download_cache_rebuilds_corrupt_index(cache_dir: str):
+    write_file(os.path.join(cache_dir, "index.json"), b"{not json")
+    write_file(os.path.join(cache_dir, HASH_A), b"image")
+    write_file(os.path.join(cache_dir, "unknown"), b"other")
+
+    load_download_cache()
+
+    cache = download_cache.download_cache
+    assert not cache.urls
+    assert list(cache.entries) == [HASH_A]
+    assert cache.entries[HASH_A].size == len(b"image")
+    assert sorted(os.listdir(cache_dir)) == [HASH_A, "index.json"]
+    with open(os.path.join(cache_dir, "index.json"), encoding="utf-8") as f:
+        assert list(json.load(f)["entries"]) == [HASH_A]
+
+
+def test_load_download_cache_drops_entries_without_file(cache_dir: str):
+    index = {
+        "urls": {"https://example.com/a.png": HASH_A, "https://example.com/b": HASH_B},
+        "entries": {
+            HASH_A: {"size": 5, "last_used": 4e9},
+            HASH_B: {"size": 5, "last_used": 4e9},
+        },
+    }
+    write_file(os.path.join(cache_dir, "index.json"), json.dumps(index).encode())
+    write_file(os.path.join(cache_dir, HASH_A), b"image")
+
+    load_download_cache()
+
+    cache = download_cache.download_cache
+    assert cache.urls == {"https://example.com/a.png": HASH_A}
+    assert list(cache.entries) == [HASH_A]
+
+
+@pytest.mark.parametrize("max_size", ["0", "1"])
+def test_add_cached_download_keeps_added_file(
+    cache_dir: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch, max_size: str
+):
+    monkeypatch.setitem(fake_weechat.config, "download_cache_max_size", max_size)
+    downloaded_path = str(tmp_path / "download.part")
+    write_file(downloaded_path, b"x" * 2 * 1024 * 1024)
+
+    path = add_cached_download("https://example.com/a.png", downloaded_path, HASH_A)
+
+    assert path == os.path.join(cache_dir, HASH_A)
+    assert os.path.isfile(path)
+    assert get_cached_download("https://example.com/a.png") == path
+
+
+def test_add_cached_download_keeps_files_in_use(
+    cache_dir: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    monkeypatch.setitem(fake_weechat.config, "download_cache_max_size", "0")
+    for content_hash in [HASH_A, HASH_B]:
+        downloaded_path = str(tmp_path / "download.part")
+        write_file(downloaded_path, b"image")
+        add_cached_download(
+            f"https://example.com/{content_hash}",
+            downloaded_path,
+            content_hash,
+            [os.path.join(cache_dir, HASH_A), "/elsewhere/image.png"],
+        )
+
+    assert sorted(download_cache.download_cache.entries) == [HASH_A, HASH_B]
+    assert os.path.isfile(os.path.join(cache_dir, HASH_A))
+
+
+def test_get_file_hash_reads_file_once(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    path = str(tmp_path / "image.png")
+    write_file(path, b"image")
+    opened: List[str] = []
+
+    def counting_open(file: str, mode: str):
+        opened.append(file)
+        return open(file, mode)
+
+    monkeypatch.setattr(download_cache, "open", counting_open, raising=False)
+
+    assert get_file_hash(path) == hashlib.sha256(b"image").hexdigest()
+    assert get_file_hash(path) == hashlib.sha256(b"image").hexdigest()
+    assert opened == [path]
+
+    write_file(path, b"other image")
+    assert get_file_hash(path) == hashlib.sha256(b"other image").hexdigest()
+    assert opened == [path, path]
+
+
+def test_get_file_hash_of_download_uses_name(cache_dir: str):
+    load_download_cache()
+    path = os.path.join(cache_dir, HASH_A)
+    write_file(path, b"image")
+    assert get_file_hash(path) == HASH_A
+
+    other_path = os.path.join(cache_dir, "image.png")
+    write_file(other_path, b"image")
+    assert get_file_hash(other_path) == hashlib.sha256(b"image").hexdigest()
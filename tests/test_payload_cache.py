@@ -0,0 +1,41 @@
+from __future__ import annotations
+
+from weechat_icat.payload_cache import set_cmds_image_id
+
+
+def test_set_cmds_image_id_replaces_id_in_control_data():
+    cmds = [
+        b"\033_Ga=T,q=2,f=100,i=1234,m=1;AAAA\033\\",
+        b"\033_Gm=0;BBBB\033\\",
+    ]
+    assert set_cmds_image_id(cmds, 42) == [
+        b"\033_Ga=T,q=2,f=100,i=42,m=1;AAAA\033\\",
+        b"\033_Gm=0;BBBB\033\\",
+    ]
+
+
+def test_set_cmds_image_id_replaces_id_at_start_of_control_data():
+    cmds = [b"\033_Gi=7,a=a,s=3,v=1\033\\"]
+    assert set_cmds_image_id(cmds, 8) == [b"\033_Gi=8,a=a,s=3,v=1\033\\"]
+
+
+def test_set_cmds_image_id_keeps_payload():
+    # The payload is base64, which can contain i= without being a key
+    cmds = [b"\033_Ga=f,i=1,m=0;xi=1,i=1\033\\"]
+    assert set_cmds_image_id(cmds, 2) == [b"\033_Ga=f,i=2,m=0;xi=1,i=1\033\\"]
+
+
+def test_set_cmds_image_id_keeps_other_keys_ending_with_i():
+    cmds = [b"\033_Ga=T,I=5,i=1\033\\"]
+    assert set_cmds_image_id(cmds, 3) == [b"\033_Ga=T,I=5,i=3\033\\"]
+
+
+def test_set_cmds_image_id_tmux():
+    cmds = [
+        b"\033Ptmux;\033\033_Ga=T,i=1,m=1;AAAA\033\033\\\033\\",
+        b"\033Ptmux;\033\033_Gm=0;i=1\033\033\\\033\\",
+    ]
+    assert set_cmds_image_id(cmds, 65535) == [
+        b"\033Ptmux;\033\033_Ga=T,i=65535,m=1;AAAA\033\033\\\033\\",
+        b"\033Ptmux;\033\033_Gm=0;i=1\033\033\\\033\\",
+    ]
@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from weechat_icat import terminal_graphics
+from weechat_icat.terminal_graphics import (
+    ImagePlacement,
+    ImagesSendFinished,
+    send_images_to_terminal,
+)
+
+results: List[ImagesSendFinished] = []
+
+
+def images_sent_cb(data: str, result: ImagesSendFinished):
+    results.append(result)
+
+
+@pytest.fixture(autouse=True)
+def tty_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    results.clear()
+    path = tmp_path / "tty"
+    monkeypatch.setattr(terminal_graphics, "open_tty", lambda: open(path, "ab"))
+    return path
+
+
+def test_send_images_to_terminal_skips_failed_images(tmp_path: Path, tty_path: Path):
+    missing_path = str(tmp_path / "missing.png")
+    image_placements = [
+        ImagePlacement(missing_path, 1, 10, 5),
+        ImagePlacement(str(tmp_path / "sent.png"), 2, 10, 5, [b"cmd"]),
+    ]
+
+    send_images_to_terminal(image_placements, images_sent_cb, "")
+
+    [result] = results
+    assert isinstance(result, list)
+    assert len(result) == 1
+    assert result[0].startswith(f"{missing_path}: ")
+    assert tty_path.read_bytes() == b"cmd"
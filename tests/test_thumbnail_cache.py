@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+from typing import Tuple
+
+import pytest
+
+from weechat_icat.thumbnail_cache import get_thumbnail_level, get_thumbnail_size
+
+
+def test_get_thumbnail_size_rounds_up():
+    assert get_thumbnail_size((1001, 1001), 0) == (1001, 1001)
+    assert get_thumbnail_size((1001, 1001), 1) == (501, 501)
+    assert get_thumbnail_size((5, 3), 2) == (2, 1)
+
+
+@pytest.mark.parametrize(
+    "original_size,target_size,level",
+    [
+        ((800, 600), (800, 600), 0),
+        ((800, 600), (1000, 1000), 0),
+        ((800, 600), (401, 300), 0),
+        ((800, 600), (400, 300), 1),
+        ((4000, 3000), (1000, 750), 2),
+        ((4000, 3000), (1001, 10), 1),
+        ((4000, 3000), (10, 751), 1),
+        # The base size is given with 0 for the dimension which doesn't matter
+        ((6000, 4000), (1024, 0), 2),
+        ((1, 1), (1, 1), 0),
+    ],
+)
+def test_get_thumbnail_level(
+    original_size: Tuple[int, int], target_size: Tuple[int, int], level: int
+):
+    assert get_thumbnail_level(original_size, target_size) == level
+
+
+@pytest.mark.parametrize("target_width", range(1, 200, 7))
+def test_get_thumbnail_level_is_smallest_large_enough(target_width: int):
+    original_size = (1920, 1080)
+    target_size = (target_width, target_width * 9 // 16)
+    level = get_thumbnail_level(original_size, target_size)
+    size = get_thumbnail_size(original_size, level)
+    assert size[0] >= target_size[0] and size[1] >= target_size[1]
+    width, height = get_thumbnail_size(original_size, level + 1)
+    # Either the next level is too small, or the size stopped shrinking at 1x1
+    assert width < target_size[0] or height < target_size[1] or (width, height) == size
+
+
+@pytest.mark.parametrize("target_size", [(1, 1), (0, 0)])
+def test_get_thumbnail_level_stops_at_one_pixel(target_size: Tuple[int, int]):
+    assert get_thumbnail_level((1, 1), target_size) == 0
+    assert get_thumbnail_level((1000, 3), target_size) == 10
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import re
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Deque, List
+
+import weechat
+
+from weechat_icat.commands import download_and_create_image
+from weechat_icat.config import config_get_bool, config_get_int, config_get_str
+from weechat_icat.download import download_queue
+from weechat_icat.log import print_error
+from weechat_icat.terminal_graphics import image_create_queue
+from weechat_icat.util import get_callback_name
+
+
+@dataclass
+class AutoDisplayState:
+    # URLs waiting to be displayed in each buffer, with the buffers in the
+    # order they are served in
+    queues: OrderedDict[str, Deque[str]]
+    timer_hook: str = ""
+    url_regex_source: str = ""
+    url_regex: re.Pattern[str] = re.compile("(?!)")
+
+
+auto_display_state = AutoDisplayState(OrderedDict())
+
+
+def get_auto_display_url_regex():
+    source = config_get_str("auto_display_url_regex")
+    if source != auto_display_state.url_regex_source:
+        auto_display_state.url_regex_source = source
+        try:
+            auto_display_state.url_regex = re.compile(source, re.IGNORECASE)
+        except re.error as e:
+            print_error(f"invalid auto_display_url_regex: {e}")
+            auto_display_state.url_regex = re.compile("(?!)")
+    return auto_display_state.url_regex
+
+
+def find_image_urls(message: str) -> List[str]:
+    return [match.group(0) for match in get_auto_display_url_regex().finditer(message)]
+
+
+def queue_auto_display_urls(buffer: str, urls: List[str]):
+    queue = auto_display_state.queues.get(buffer)
+    if queue is None:
+        queue_size = max(1, config_get_int("auto_display_queue_size"))
+        queue = auto_display_state.queues[buffer] = deque(maxlen=queue_size)
+    for url in urls:
+        # When the queue is full, the oldest URL is dropped, since it has
+        # probably scrolled away already in a busy buffer
+        if url not in queue:
+            queue.append(url)
+
+    if not auto_display_state.timer_hook:
+        interval = max(1, config_get_int("auto_display_interval"))
+        auto_display_state.timer_hook = weechat.hook_timer(
+            interval, 0, 0, get_callback_name(auto_display_timer_cb), ""
+        )
+
+
+def stop_auto_display_timer():
+    if auto_display_state.timer_hook:
+        weechat.unhook(auto_display_state.timer_hook)
+        auto_display_state.timer_hook = ""
+
+
+def auto_display_timer_cb(data: str, remaining_calls: int) -> int:
+    # Start at most one image per interval, taking the buffers in turn so a
+    # busy buffer can't starve the others
+    queues = auto_display_state.queues
+    if not queues:
+        stop_auto_display_timer()
+        return weechat.WEECHAT_RC_OK
+
+    # Wait while images are already waiting for a download or create job, so
+    # the queues stay bounded and the newest URLs win
+    if download_queue or image_create_queue:
+        return weechat.WEECHAT_RC_OK
+
+    buffer, queue = next(iter(queues.items()))
+    url = queue.popleft()
+    if queue:
+        queues.move_to_end(buffer)
+    else:
+        del queues[buffer]
+
+    # Errors aren't printed for images displayed automatically, since they
+    # weren't asked for
+    rows = max(1, config_get_int("auto_display_rows"))
+    download_and_create_image(buffer, url, None, rows, False, True)
+    return weechat.WEECHAT_RC_OK
+
+
+def auto_display_print_cb(
+    data: str,
+    buffer: str,
+    date: str,
+    tags: str,
+    displayed: int,
+    highlight: int,
+    prefix: str,
+    message: str,
+) -> int:
+    # This is called for every line printed, so do as little as possible
+    # here and leave the rest to the timer
+    if not displayed or not config_get_bool("auto_display"):
+        return weechat.WEECHAT_RC_OK
+    if not weechat.buffer_match_list(buffer, config_get_str("auto_display_buffers")):
+        return weechat.WEECHAT_RC_OK
+
+    urls = find_image_urls(message)
+    if urls:
+        queue_auto_display_urls(buffer, urls)
+    return weechat.WEECHAT_RC_OK
+
+
+def auto_display_buffer_closing_cb(data: str, signal: str, signal_data: str) -> int:
+    auto_display_state.queues.pop(signal_data, None)
+    return weechat.WEECHAT_RC_OK
+
+
+def register_auto_display_hooks():
+    weechat.hook_print("", "", "://", 1, get_callback_name(auto_display_print_cb), "")
+    weechat.hook_signal(
+        "buffer_closing", get_callback_name(auto_display_buffer_closing_cb), ""
+    )
@@ -0,0 +1,329 @@
+from __future__ import annotations
+
+import os
+import pickle
+import signal
+import struct
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+from uuid import uuid4
+
+import weechat
+
+from weechat_icat.config import config_get_bool
+from weechat_icat.metrics import record_latency
+from weechat_icat.shared import WeechatCallbackReturnType, shared
+from weechat_icat.util import get_callback_name
+
+ProcessCallback = Callable[[str, str, int, str, str], int]
+
+FRAME_HEADER = struct.Struct("!I")
+RESULT_FILE_PREFIX = "icat-result-"
+
+
+@dataclass
+class BackgroundJob:
+    callback_name: str
+    callback_data: str
+    timeout: float
+    mode: str
+    start_time: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class RenderWorker:
+    pid: int
+    job_fd: int
+    result_fd: int
+    hook_read: str
+    hook_write: str = ""
+    hook_timer: str = ""
+    out_buffer: bytearray = field(default_factory=bytearray)
+    in_buffer: bytearray = field(default_factory=bytearray)
+
+
+background_jobs: Dict[str, BackgroundJob] = {}
+render_worker: Optional[RenderWorker] = None
+background_job_functions: List[Callable[[str], str]] = []
+
+
+def background_job_finished(
+    job_id: str, command: str, return_code: int, out: str, err: str
+) -> int:
+    job = background_jobs.get(job_id)
+    if job is None:
+        return weechat.WEECHAT_RC_OK
+
+    if return_code != weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+        del background_jobs[job_id]
+        # Latency from starting the job until it has finished, for jobs run
+        # in forked processes and in the render worker
+        record_latency(f"{job.mode}_job", time.monotonic() - job.start_time)
+
+    callback: ProcessCallback = shared.weechat_callbacks[job.callback_name]  # type: ignore
+    return callback(job.callback_data, command, return_code, out, err)
+
+
+def background_job(function: Callable[[str], str]) -> Callable[[str], str]:
+    # Functions run with run_in_background have to be marked with this, since
+    # the render worker only knows the callbacks registered before it's forked
+    background_job_functions.append(function)
+    return function
+
+
+def background_job_run(job_serialized: str) -> str:
+    _, function_name, data = job_serialized.split(" ", 2)
+    return shared.weechat_callbacks[function_name](data)  # type: ignore
+
+
+def background_job_cb(
+    job_serialized: str,
+    command: str,
+    return_code: int,
+    out_chunk: str,
+    err_chunk: str,
+) -> int:
+    job_id = job_serialized.split(" ", 1)[0]
+    return background_job_finished(job_id, command, return_code, out_chunk, err_chunk)
+
+
+def run_in_background(
+    function: Callable[[str], str],
+    timeout: int,
+    callback: Callable[..., WeechatCallbackReturnType],
+    callback_data: str,
+):
+    # The callback is called with the same arguments as for hook_process
+    job_id = str(uuid4())
+    use_worker = config_get_bool("render_worker")
+    background_jobs[job_id] = BackgroundJob(
+        get_callback_name(callback),
+        callback_data,
+        timeout / 1000,
+        "worker" if use_worker else "fork",
+    )
+
+    job_serialized = f"{job_id} {get_callback_name(function)} {callback_data}"
+    if use_worker:
+        send_render_worker_job(job_serialized)
+    else:
+        weechat.hook_process(
+            "func:" + get_callback_name(background_job_run),
+            timeout,
+            get_callback_name(background_job_cb),
+            job_serialized,
+        )
+
+
+def get_background_result_dir():
+    # Use shared memory if available, so the result isn't written to disk
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def write_background_result(result: object) -> str:
+    # Results can contain the whole payload sent to the terminal, so only the
+    # path of the file they are written to is passed back through the pipe
+    fd, path = tempfile.mkstemp(
+        prefix=RESULT_FILE_PREFIX, dir=get_background_result_dir()
+    )
+    with os.fdopen(fd, "wb") as f:
+        pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def remove_background_result(path: str):
+    if os.path.basename(path).startswith(RESULT_FILE_PREFIX):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def read_background_result(path: str) -> Any:
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    finally:
+        remove_background_result(path)
+
+
+def close_other_fds(keep_fds: List[int]):
+    # The worker lives for a long time, so it mustn't keep WeeChat's sockets
+    # and files open after WeeChat closes them
+    fd_start = 3
+    for fd in sorted(keep_fds):
+        os.closerange(fd_start, fd)
+        fd_start = fd + 1
+    os.closerange(fd_start, os.sysconf("SC_OPEN_MAX"))
+
+
+def read_exactly(fd: int, size: int):
+    data = bytearray()
+    while len(data) < size:
+        chunk = os.read(fd, size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def render_worker_main(job_fd: int, result_fd: int):
+    while True:
+        header = read_exactly(job_fd, FRAME_HEADER.size)
+        if header is None:
+            return
+        frame = read_exactly(job_fd, FRAME_HEADER.unpack(header)[0])
+        if frame is None:
+            return
+
+        job_serialized = frame.decode()
+        job_id = job_serialized.split(" ", 1)[0]
+        try:
+            result = (job_id, background_job_run(job_serialized), "")
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            result = (job_id, "", f"render worker job failed: {e!r}")
+
+        payload = pickle.dumps(result)
+        os.write(result_fd, FRAME_HEADER.pack(len(payload)))
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(result_fd, view) :]
+
+
+def start_render_worker():
+    global render_worker
+    job_read_fd, job_write_fd = os.pipe()
+    result_read_fd, result_write_fd = os.pipe()
+
+    for function in background_job_functions:
+        get_callback_name(function)
+    pid = os.fork()
+    if pid == 0:
+        # Never return to WeeChat's main loop in the worker
+        try:
+            close_other_fds([job_read_fd, result_write_fd])
+            render_worker_main(job_read_fd, result_write_fd)
+        finally:
+            os._exit(0)  # pylint: disable=protected-access
+
+    os.close(job_read_fd)
+    os.close(result_write_fd)
+    os.set_blocking(job_write_fd, False)
+    os.set_blocking(result_read_fd, False)
+    render_worker = RenderWorker(
+        pid,
+        job_write_fd,
+        result_read_fd,
+        weechat.hook_fd(
+            result_read_fd, 1, 0, 0, get_callback_name(render_worker_read_cb), ""
+        ),
+    )
+    render_worker.hook_timer = weechat.hook_timer(
+        5000, 0, 0, get_callback_name(render_worker_timer_cb), ""
+    )
+    return render_worker
+
+
+def is_render_worker_running():
+    return render_worker is not None
+
+
+def stop_render_worker(error: str = "render worker stopped"):
+    global render_worker
+    worker = render_worker
+    if worker is None:
+        return
+    render_worker = None
+
+    for hook in [worker.hook_read, worker.hook_write, worker.hook_timer]:
+        if hook:
+            weechat.unhook(hook)
+    os.close(worker.job_fd)
+    os.close(worker.result_fd)
+    try:
+        os.kill(worker.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    os.waitpid(worker.pid, 0)
+
+    for job_id, job in list(background_jobs.items()):
+        if job.mode == "worker":
+            background_job_finished(
+                job_id, "", weechat.WEECHAT_HOOK_PROCESS_ERROR, "", error
+            )
+
+
+def flush_render_worker(worker: RenderWorker):
+    try:
+        while worker.out_buffer:
+            written = os.write(worker.job_fd, worker.out_buffer)
+            del worker.out_buffer[:written]
+    except BlockingIOError:
+        pass
+    except OSError:
+        stop_render_worker("render worker exited")
+        return
+
+    # Wait for the pipe to be writable instead of blocking WeeChat
+    if worker.out_buffer and not worker.hook_write:
+        worker.hook_write = weechat.hook_fd(
+            worker.job_fd, 0, 1, 0, get_callback_name(render_worker_write_cb), ""
+        )
+    elif not worker.out_buffer and worker.hook_write:
+        weechat.unhook(worker.hook_write)
+        worker.hook_write = ""
+
+
+def send_render_worker_job(job_serialized: str):
+    worker = render_worker or start_render_worker()
+    payload = job_serialized.encode()
+    worker.out_buffer += FRAME_HEADER.pack(len(payload))
+    worker.out_buffer += payload
+    flush_render_worker(worker)
+
+
+def render_worker_write_cb(data: str, fd: int) -> int:
+    if render_worker:
+        flush_render_worker(render_worker)
+    return weechat.WEECHAT_RC_OK
+
+
+def render_worker_read_cb(data: str, fd: int) -> int:
+    worker = render_worker
+    if worker is None:
+        return weechat.WEECHAT_RC_OK
+
+    try:
+        while True:
+            chunk = os.read(worker.result_fd, 1024 * 1024)
+            if not chunk:
+                stop_render_worker("render worker exited")
+                return weechat.WEECHAT_RC_OK
+            worker.in_buffer += chunk
+    except BlockingIOError:
+        pass
+
+    while len(worker.in_buffer) >= FRAME_HEADER.size:
+        (length,) = FRAME_HEADER.unpack_from(worker.in_buffer)
+        if len(worker.in_buffer) < FRAME_HEADER.size + length:
+            break
+        frame = bytes(worker.in_buffer[FRAME_HEADER.size : FRAME_HEADER.size + length])
+        del worker.in_buffer[: FRAME_HEADER.size + length]
+        job_id, out, err = pickle.loads(frame)
+        background_job_finished(job_id, "render_worker", 1 if err else 0, out, err)
+    return weechat.WEECHAT_RC_OK
+
+
+def render_worker_timer_cb(data: str, remaining_calls: int) -> int:
+    # The worker runs one job at a time, so if a job hangs, restart the worker
+    # to let the other jobs run
+    now = time.monotonic()
+    for job in background_jobs.values():
+        if job.mode == "worker" and now - job.start_time > job.timeout:
+            stop_render_worker("render worker job timed out")
+            break
+    return weechat.WEECHAT_RC_OK
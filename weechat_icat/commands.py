@@ -4,30 +4,40 @@ import os
 import pickle
 import re
 from base64 import b64decode, b64encode
-from collections import defaultdict
 from dataclasses import dataclass
 from typing import Dict, List, Optional
 from uuid import uuid4
 
-import PIL
 import weechat
 
-from weechat_icat.download import download_image
-from weechat_icat.log import print_error, print_info
+from weechat_icat.download import download_image, download_stats
+from weechat_icat.download_cache import add_cached_download, get_cached_download
+from weechat_icat.image import is_unidentified_image_error
+from weechat_icat.log import print_error
+from weechat_icat.metrics import count_metric
+from weechat_icat.placements import (
+    add_image_placement_buffer,
+    get_image_placement,
+    get_image_placement_paths,
+    get_image_placements,
+    register_image_placement,
+    set_image_placement_cmds,
+    touch_image_placement,
+    unregister_image_placements,
+)
 from weechat_icat.python_compatibility import removeprefix
+from weechat_icat.restore import cancel_restore, start_restore
 from weechat_icat.shared import shared
+from weechat_icat.stats import print_stats
 from weechat_icat.terminal_graphics import (
     ImageCreateFinished,
     ImagePlacement,
-    ImagesSendFinished,
     create_and_send_image_to_terminal,
     display_image,
-    send_images_to_terminal,
 )
 from weechat_icat.util import get_callback_name
 
-downloaded_images: Dict[str, str] = {}
-image_placements: Dict[str, List[ImagePlacement]] = defaultdict(list)
+downloads_in_progress: Dict[str, List[ImageDownloadedData]] = {}
 
 
 @dataclass
@@ -38,6 +48,7 @@ class ImageDownloadedData:
     columns: Optional[int]
     rows: Optional[int]
     print_immediately: bool
+    quiet: bool
 
 
 @dataclass
@@ -45,6 +56,7 @@ class ImageCreatedData:
     buffer: str
     path: str
     print_immediately: bool
+    quiet: bool
 
 
 def parse_options(args: str, supported_options: Dict[str, bool]):
@@ -70,15 +82,28 @@ def parse_options(args: str, supported_options: Dict[str, bool]):
 
 def new_image_placement(buffer: str, image_placement: ImagePlacement):
     display_image(buffer, image_placement)
-    image_placements[image_placement.path].append(image_placement)
+    register_image_placement(image_placement)
+    add_image_placement_buffer(buffer, image_placement)
 
 
-def image_downloaded_cb(data_serialized: str):
+def image_downloaded_cb(data_serialized: str, content_hash: Optional[str]):
     data: ImageDownloadedData = pickle.loads(b64decode(data_serialized))
-    downloaded_images[data.url] = data.path
-    create_image(
-        data.buffer, data.path, data.columns, data.rows, data.print_immediately
+    waiting = downloads_in_progress.pop(data.url, [])
+    if content_hash is None:
+        return
+
+    path = add_cached_download(
+        data.url, data.path, content_hash, get_image_placement_paths()
     )
+    for request in waiting:
+        create_image(
+            request.buffer,
+            path,
+            request.columns,
+            request.rows,
+            request.print_immediately,
+            request.quiet,
+        )
 
 
 def image_created_cb(
@@ -90,49 +115,59 @@ def image_created_cb(
 
     if isinstance(result, Exception):
         if image_placement_was_returned:
-            del image_placements[data.path]
+            unregister_image_placements(data.path)
 
-        if isinstance(result, PIL.UnidentifiedImageError):
-            print_error("failed to load image")
+        if is_unidentified_image_error(result):
+            print_error("failed to load image", data.quiet)
             return
 
-        print_error("failed displaying image:")
+        print_error("failed displaying image:", data.quiet)
         raise result
 
-    if data.print_immediately and image_placement_was_returned:
+    image_placement = (
+        get_image_placement(result.image_id) if image_placement_was_returned else None
+    )
+    if image_placement:
+        # The placement was registered before it was sent, either because of
+        # print_immediately or because a preview was shown, so keep the
+        # commands from sending it for restoring
+        set_image_placement_cmds(image_placement, result.terminal_cmds)
+        weechat.command(data.buffer, "/window refresh")
+    elif data.print_immediately and image_placement_was_returned:
         weechat.command(data.buffer, "/window refresh")
     else:
         new_image_placement(data.buffer, result)
 
 
-def images_restored_cb(buffer: str, result: ImagesSendFinished):
-    if isinstance(result, Exception):
-        print_error("failed restoring images:")
-        raise result
-
-    weechat.command(buffer, "/window refresh")
-    print_info("finished restoring images")
-
-
 def download_and_create_image(
     buffer: str,
     url: str,
     columns: Optional[int],
     rows: Optional[int],
     print_immediately: bool,
+    quiet: bool,
 ):
-    downloaded_path = downloaded_images.get(url)
-    if downloaded_path and os.path.isfile(downloaded_path):
+    downloaded_path = get_cached_download(url)
+    count_metric("download_cache_hits" if downloaded_path else "download_cache_misses")
+    if downloaded_path:
         create_image(
             buffer,
             downloaded_path,
             columns,
             rows,
             bool(print_immediately),
+            quiet,
         )
+    elif url in downloads_in_progress:
+        downloads_in_progress[url].append(
+            ImageDownloadedData(
+                buffer, url, "", columns, rows, bool(print_immediately), quiet
+            )
+        )
+        download_stats.coalesced += 1
     else:
         save_path = weechat.string_eval_path_home(
-            f"{shared.cache_downloaded_images_path}/{uuid4()}", {}, {}, {}
+            f"{shared.cache_downloaded_images_path}/{uuid4()}.part", {}, {}, {}
         )
         image_downloaded_data = ImageDownloadedData(
             buffer,
@@ -141,9 +176,11 @@ def download_and_create_image(
             columns,
             rows,
             bool(print_immediately),
+            quiet,
         )
+        downloads_in_progress[url] = [image_downloaded_data]
         callback_data = b64encode(pickle.dumps(image_downloaded_data)).decode("ascii")
-        download_image(url, save_path, image_downloaded_cb, callback_data)
+        download_image(url, save_path, image_downloaded_cb, callback_data, quiet)
 
 
 def create_image(
@@ -152,16 +189,19 @@ def create_image(
     columns: Optional[int],
     rows: Optional[int],
     print_immediately: bool,
+    quiet: bool,
 ):
-    for ip in image_placements[path]:
+    for ip in get_image_placements(path):
         if (columns is None or columns == ip.columns) and (
             rows is None or rows == ip.rows
         ):
             image_placement = ip
             display_image(buffer, image_placement)
+            touch_image_placement(image_placement)
+            add_image_placement_buffer(buffer, image_placement)
             break
     else:
-        image_created_data = ImageCreatedData(buffer, path, print_immediately)
+        image_created_data = ImageCreatedData(buffer, path, print_immediately, quiet)
         callback_data = b64encode(pickle.dumps(image_created_data)).decode("ascii")
         image_placement = create_and_send_image_to_terminal(
             path, columns, rows, image_created_cb, callback_data
@@ -178,48 +218,60 @@ def icat_cb(data: str, buffer: str, args: str) -> int:
             "rows": True,
             "print_immediately": False,
             "restore": False,
+            "cancel_restore": False,
+            "stats": False,
             "quiet": False,
         },
     )
-    shared.print_errors = not options.get("quiet")
-    if "restore" in options:
-        image_placements_values = [
-            image_placement
-            for image_placement_list in image_placements.values()
-            for image_placement in image_placement_list
-        ]
-        send_images_to_terminal(image_placements_values, images_restored_cb, buffer)
+    quiet = "quiet" in options
+    if "stats" in options:
+        print_stats()
+    elif "cancel_restore" in options:
+        cancel_restore()
+    elif "restore" in options:
+        start_restore(buffer, quiet)
     else:
         columns = options.get("columns")
         if columns is not None and not columns.isdecimal():
-            print_error("columns must be a positive integer")
+            print_error("columns must be a positive integer", quiet)
             return weechat.WEECHAT_RC_ERROR
         columns_int = int(columns) if columns else None
 
         rows = options.get("rows")
         if rows is not None and not rows.isdecimal():
-            print_error("rows must be a positive integer")
+            print_error("rows must be a positive integer", quiet)
             return weechat.WEECHAT_RC_ERROR
         rows_int = int(rows) if rows else None
 
         print_immediately = options.get("print_immediately")
         if print_immediately and (not columns_int or not rows_int):
             print_error(
-                "both -columns and -rows must be specified when using -print_immediately"
+                "both -columns and -rows must be specified when using -print_immediately",
+                quiet,
             )
             return weechat.WEECHAT_RC_ERROR
 
         path_or_url = weechat.string_eval_path_home(pos_args, {}, {}, {})
         if path_or_url.startswith(("http://", "https://")):
             download_and_create_image(
-                buffer, path_or_url, columns_int, rows_int, bool(print_immediately)
+                buffer,
+                path_or_url,
+                columns_int,
+                rows_int,
+                bool(print_immediately),
+                quiet,
             )
         elif os.path.isfile(path_or_url):
             create_image(
-                buffer, path_or_url, columns_int, rows_int, bool(print_immediately)
+                buffer,
+                path_or_url,
+                columns_int,
+                rows_int,
+                bool(print_immediately),
+                quiet,
             )
         else:
-            print_error("filename must point to an existing file")
+            print_error("filename must point to an existing file", quiet)
             return weechat.WEECHAT_RC_ERROR
 
     return weechat.WEECHAT_RC_OK
@@ -234,17 +286,30 @@ def register_commands():
         "          filename: image to display\n"
         "            -quiet: don't print any error messages\n"
         "          -restore: instead of displaying a new image, restore the existing "
-        "images to a new terminal instance\n"
+        "images to a new terminal instance; images in the displayed buffers are "
+        "restored first, and the rest when their buffers are displayed\n"
+        "   -cancel_restore: stop restoring images in buffers which are displayed "
+        "later\n"
+        "            -stats: print latencies of each stage of displaying images "
+        "(download, queue wait, background job, decode, encode and transmit), "
+        "counters like bytes written to the terminal and cache hits, and the "
+        "current queue lengths; also available as the info and infolist "
+        "icat_stats\n"
         "\n"
         "Note that images are loaded in the background, so they may not be "
-        "displayed immediately after running the command."
+        "displayed immediately after running the command.\n"
+        "\n"
+        "Images from http and https URLs are downloaded with Python's urllib. "
+        "The proxy in weechat.network.proxy_curl is used if it's an http proxy, "
+        "but the TLS options of WeeChat aren't, so the certificates are "
+        "verified with the certificate authorities of the system."
     )
     weechat.hook_command(
         "icat",
         "display an image in the chat",
-        "[-columns <columns>] [-rows <rows>] [-print_immediately] [-quiet] <filename> || -restore [-quiet]",
+        "[-columns <columns>] [-rows <rows>] [-print_immediately] [-quiet] <filename> || -restore [-quiet] || -cancel_restore || -stats",
         command_icat_description,
-        "-columns|-rows|-print_immediately|-quiet|%* || -restore|-quiet|%*",
+        "-columns|-rows|-print_immediately|-quiet|%* || -restore|-quiet|%* || -cancel_restore || -stats",
         get_callback_name(icat_cb),
         "",
     )
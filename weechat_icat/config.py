@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict
+
+import weechat
+
+
+@dataclass
+class ConfigOption:
+    default: str
+    description: str
+
+
+config_options: Dict[str, ConfigOption] = {
+    "max_image_create_jobs": ConfigOption(
+        "4",
+        "maximum number of images to decode, encode and send to the terminal "
+        "concurrently",
+    ),
+    "report_burst_throughput": ConfigOption(
+        "off",
+        "print the number of images and bytes created per second after a burst "
+        "of images has been created",
+    ),
+    "downscale": ConfigOption(
+        "off",
+        "resize images to the pixel size of the cells they are displayed in "
+        "before sending them to the terminal",
+    ),
+    "downscale_resample": ConfigOption(
+        "lanczos",
+        "resampling filter used when downscaling images "
+        "(nearest, box, bilinear, hamming, bicubic or lanczos)",
+    ),
+    "downscale_max_oversampling": ConfigOption(
+        "1.0",
+        "when downscaling, keep up to this many times the pixel size of the "
+        "cells, to retain detail if the terminal font size is increased",
+    ),
+    "transmission_format": ConfigOption(
+        "png",
+        "format to send images to the terminal in: png, raw (RGB/RGBA pixels "
+        "compressed with zlib) or auto (send PNG files as is and other images "
+        "as raw, which is faster to encode but uses more bytes than png)",
+    ),
+    "transmission_compression_level": ConfigOption(
+        "1",
+        "zlib compression level (0-9) used for the raw transmission format",
+    ),
+    "transmission_medium": ConfigOption(
+        "direct",
+        "how to send image data to the terminal: direct (in the escape codes), "
+        "file (let the terminal read PNG files directly, and other images from a "
+        "temporary file), temp_file, shared_memory or auto (file if the terminal "
+        "is local); anything other than direct falls back to direct when running "
+        "in ssh or tmux",
+    ),
+    "download_cache_max_size": ConfigOption(
+        "500",
+        "maximum size in MiB of downloaded images to keep, the least recently "
+        "used images are removed first",
+    ),
+    "download_cache_max_age": ConfigOption(
+        "30",
+        "number of days to keep downloaded images after they were last used",
+    ),
+    "max_concurrent_downloads": ConfigOption(
+        "4",
+        "maximum number of images to download concurrently, the rest are queued",
+    ),
+    "download_max_size": ConfigOption(
+        "50",
+        "maximum size in MiB of images to download, larger downloads are aborted",
+    ),
+    "download_timeout": ConfigOption(
+        "60",
+        "number of seconds after which a download is aborted",
+    ),
+    "payload_cache_max_size": ConfigOption(
+        "200",
+        "maximum size in MiB of the cache of data sent to the terminal, which "
+        "lets images be displayed again without decoding and encoding them; "
+        "set to 0 to disable the cache",
+    ),
+    "thumbnail_cache_max_size": ConfigOption(
+        "200",
+        "maximum size in MiB of the cache of reduced versions of downscaled "
+        "images, which lets other sizes of an image be created without "
+        "decoding the original; set to 0 to disable the cache",
+    ),
+    "animations": ConfigOption(
+        "on",
+        "show the frames of animated images, instead of only the first frame",
+    ),
+    "animation_max_frames": ConfigOption(
+        "100",
+        "maximum number of frames to show of animated images; the animation "
+        "loops over the frames before this",
+    ),
+    "animation_max_size": ConfigOption(
+        "20",
+        "maximum size in MiB of the frames sent to the terminal for each "
+        "animated image, not counting the first frame; the animation loops "
+        "over the frames before this",
+    ),
+    "progressive_preview": ConfigOption(
+        "off",
+        "show a preview with a very low resolution of images first, and replace "
+        "it with the full image when that is ready",
+    ),
+    "progressive_preview_size": ConfigOption(
+        "32",
+        "maximum width and height in pixels of the previews shown with "
+        "progressive_preview",
+    ),
+    "placements_max_memory": ConfigOption(
+        "100",
+        "maximum size in MiB of the data sent to the terminal to keep in memory "
+        "for restoring images; when exceeded, the data of the least recently "
+        "used images is dropped and created again if they are restored",
+    ),
+    "render_worker": ConfigOption(
+        "off",
+        "create and send images in a long-lived background process instead of "
+        "forking WeeChat for each job; the worker runs one job at a time",
+    ),
+    "auto_display": ConfigOption(
+        "off",
+        "automatically display images linked to in messages",
+    ),
+    "auto_display_buffers": ConfigOption(
+        "*",
+        "comma separated list of buffers to automatically display images in; "
+        '"*" means all buffers, a name beginning with "!" is excluded, and '
+        'wildcard "*" is allowed (e.g. "irc.libera.*,!irc.libera.#busy")',
+    ),
+    "auto_display_url_regex": ConfigOption(
+        r"https?://[^\s\"'<>]+\.(?:png|jpe?g|gif|webp)(?:\?[^\s\"'<>]*)?",
+        "regular expression for the URLs to automatically display images from",
+    ),
+    "auto_display_rows": ConfigOption(
+        "5",
+        "number of rows to display automatically displayed images with",
+    ),
+    "auto_display_interval": ConfigOption(
+        "500",
+        "minimum time in milliseconds between starting to display images "
+        "automatically",
+    ),
+    "auto_display_queue_size": ConfigOption(
+        "10",
+        "maximum number of images waiting to be displayed automatically in each "
+        "buffer; the oldest are skipped when exceeded",
+    ),
+    "trace_jobs": ConfigOption(
+        "off",
+        "append an event in JSON for each stage of each background job, with "
+        "timestamps, image sizes, payload bytes and the process id, to "
+        "job_trace.jsonl in the cache directory; the file isn't truncated, so "
+        "remove it when done",
+    ),
+    "profile_jobs": ConfigOption(
+        "off",
+        "write a profile of each background job, for use with the pstats "
+        "module, to the profiles directory in the cache directory",
+    ),
+}
+
+
+def init_config():
+    for name, option in config_options.items():
+        if not weechat.config_is_set_plugin(name):
+            weechat.config_set_plugin(name, option.default)
+        weechat.config_set_desc_plugin(
+            name, f'{option.description} (default: "{option.default}")'
+        )
+
+
+def config_get_str(name: str) -> str:
+    return weechat.config_get_plugin(name) or config_options[name].default
+
+
+def config_get_int(name: str) -> int:
+    try:
+        return int(weechat.config_get_plugin(name))
+    except ValueError:
+        return int(config_options[name].default)
+
+
+def config_get_float(name: str) -> float:
+    try:
+        return float(weechat.config_get_plugin(name))
+    except ValueError:
+        return float(config_options[name].default)
+
+
+def config_get_bool(name: str) -> bool:
+    return bool(weechat.config_string_to_boolean(config_get_str(name)))
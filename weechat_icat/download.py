@@ -1,59 +1,261 @@
 from __future__ import annotations
 
+import hashlib
+import importlib
+import os
 import pickle
+import time
 from base64 import b64decode, b64encode
 from collections import defaultdict
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from io import StringIO
-from typing import Callable, Dict
+from typing import Callable, Dict, List, Optional, Union
 from uuid import UUID, uuid4
 
 import weechat
 
+from weechat_icat.config import config_get_float, config_get_int
 from weechat_icat.log import print_error
+from weechat_icat.metrics import record_latency
 from weechat_icat.util import get_callback_name
 
 string_buffers: Dict[str, StringIO] = defaultdict(StringIO)
+download_queue: List[DownloadImageData] = []
+downloads_running: Dict[UUID, DownloadImageData] = {}
+
+# Some servers don't set a proper content type for images
+allowed_content_types = ["application/octet-stream", "binary/octet-stream"]
+
+
+class DownloadRejected(Exception):
+    pass
+
+
+# The sha256 hash of the downloaded file, or the error if it failed
+DownloadFinished = Union[str, Exception]
+
+
+@dataclass
+class DownloadStats:
+    coalesced: int = 0
+    rejected: int = 0
+
+
+download_stats = DownloadStats()
+
+
+@dataclass
+class DownloadProxy:
+    type: str
+    address: str
+    port: int
+    username: str
+    password: str
 
 
 @dataclass
 class DownloadImageData:
-    callback: Callable[[str], None]
+    url: str
+    save_path: str
+    max_size: int
+    timeout: float
+    # Called with the hash of the downloaded file, or None if it failed
+    callback: Callable[[str, Optional[str]], None]
     callback_data: str
-    uuid: UUID = uuid4()
+    quiet: bool
+    proxy: Optional[DownloadProxy]
+    uuid: UUID = field(default_factory=uuid4)
+    start_time: float = 0.0
+
+
+def check_download_headers(
+    content_type: str, content_length: Optional[str], max_size: int
+):
+    content_type = content_type.split(";")[0].strip().lower()
+    if (
+        content_type
+        and not content_type.startswith("image/")
+        and content_type not in allowed_content_types
+    ):
+        raise DownloadRejected(f"content type {content_type} is not an image")
+    if content_length and content_length.isdecimal() and int(content_length) > max_size:
+        raise DownloadRejected(f"image is larger than {max_size} bytes")
+
+
+def get_download_proxy() -> Optional[DownloadProxy]:
+    # Images are downloaded with urllib instead of by WeeChat, so use the proxy
+    # WeeChat uses for its downloads
+    name = weechat.config_string(weechat.config_get("weechat.network.proxy_curl"))
+    if not name:
+        return None
+
+    def get_option(option_name: str):
+        return weechat.config_get(f"weechat.proxy.{name}.{option_name}")
+
+    def get_evaluated_option(option_name: str):
+        value = weechat.config_string(get_option(option_name))
+        return weechat.string_eval_expression(value, {}, {}, {})
+
+    if not get_option("address"):
+        return None
+    return DownloadProxy(
+        weechat.config_string(get_option("type")),
+        get_evaluated_option("address"),
+        weechat.config_integer(get_option("port")),
+        get_evaluated_option("username"),
+        get_evaluated_option("password"),
+    )
+
+
+def get_proxy_url(proxy: DownloadProxy):
+    from urllib.parse import quote  # pylint: disable=import-outside-toplevel
+
+    if proxy.type != "http":
+        raise RuntimeError(
+            f"{proxy.type} proxies aren't supported for downloading images, "
+            "only http proxies are"
+        )
+    credentials = ""
+    if proxy.username:
+        credentials = quote(proxy.username, safe="")
+        if proxy.password:
+            credentials += ":" + quote(proxy.password, safe="")
+        credentials += "@"
+    host = f"[{proxy.address}]" if ":" in proxy.address else proxy.address
+    return f"http://{credentials}{host}:{proxy.port}"
+
+
+def download_image_bg(data_serialized: str) -> str:
+    import urllib.request  # pylint: disable=import-outside-toplevel
+
+    data: DownloadImageData = pickle.loads(b64decode(data_serialized))
+    try:
+        handlers: List[urllib.request.BaseHandler] = []
+        if data.proxy:
+            proxy_url = get_proxy_url(data.proxy)
+            handlers.append(
+                urllib.request.ProxyHandler({"http": proxy_url, "https": proxy_url})
+            )
+        opener = urllib.request.build_opener(*handlers)
+        deadline = time.monotonic() + data.timeout
+        with opener.open(data.url, timeout=data.timeout) as response:
+            check_download_headers(
+                response.headers.get("Content-Type", ""),
+                response.headers.get("Content-Length"),
+                data.max_size,
+            )
+            size = 0
+            # The hash is used as the name in the download cache, so compute
+            # it here instead of reading the file again in WeeChat
+            file_hash = hashlib.sha256()
+            with open(data.save_path, "wb") as f:
+                # Enforce the limits while downloading, since Content-Length
+                # may be missing or wrong
+                for chunk in iter(lambda: response.read(64 * 1024), b""):
+                    size += len(chunk)
+                    if size > data.max_size:
+                        raise DownloadRejected(
+                            f"image is larger than {data.max_size} bytes"
+                        )
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"download took over {data.timeout}s")
+                    f.write(chunk)
+                    file_hash.update(chunk)
+        result: DownloadFinished = file_hash.hexdigest()
+        return b64encode(pickle.dumps(result)).decode("ascii")
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        if os.path.exists(data.save_path):
+            os.remove(data.save_path)
+        # Exceptions from urllib, like HTTPError, can't always be pickled
+        error = e if isinstance(e, DownloadRejected) else RuntimeError(str(e))
+        return b64encode(pickle.dumps(error)).decode("ascii")
 
 
 def download_image_cb(
     data_serialized: str, command: str, return_code: int, out_chunk: str, err_chunk: str
 ) -> int:
     data: DownloadImageData = pickle.loads(b64decode(data_serialized))
+    out_key = f"{str(data.uuid)}_out"
     err_key = f"{str(data.uuid)}_err"
+    string_buffers[out_key].write(out_chunk)
     string_buffers[err_key].write(err_chunk)
 
     if return_code == -1:
         return weechat.WEECHAT_RC_OK
 
+    out = string_buffers[out_key].getvalue()
     err = string_buffers[err_key].getvalue()
+    string_buffers[out_key].close()
     string_buffers[err_key].close()
+    del string_buffers[out_key]
     del string_buffers[err_key]
 
+    downloads_running.pop(data.uuid, None)
+    record_latency("download", time.monotonic() - data.start_time)
+    start_downloads()
+
     if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR or return_code > 0 or err:
-        print_error(f"failed downloading image, return_code={return_code}, err='{err}'")
+        # The job may have been killed before it could remove the partial file
+        if os.path.exists(data.save_path):
+            os.remove(data.save_path)
+        print_error(
+            f"failed downloading image, return_code={return_code}, err='{err}'",
+            data.quiet,
+        )
+        data.callback(data.callback_data, None)
         return weechat.WEECHAT_RC_OK
 
-    data.callback(data.callback_data)
+    result: DownloadFinished = pickle.loads(b64decode(out))
+    if isinstance(result, DownloadRejected):
+        download_stats.rejected += 1
+        print_error(f"rejected downloading image: {result}", data.quiet)
+        data.callback(data.callback_data, None)
+    elif isinstance(result, Exception):
+        print_error(f"failed downloading image: {result}", data.quiet)
+        data.callback(data.callback_data, None)
+    else:
+        data.callback(data.callback_data, result)
     return weechat.WEECHAT_RC_OK
 
 
+def start_downloads():
+    max_downloads = max(1, config_get_int("max_concurrent_downloads"))
+    if download_queue:
+        # urllib.request takes a while to import, so it's not imported when
+        # the script is loaded, but before forking so each download doesn't
+        # have to import it
+        importlib.import_module("urllib.request")
+    while download_queue and len(downloads_running) < max_downloads:
+        data = download_queue.pop(0)
+        downloads_running[data.uuid] = data
+        data.start_time = time.monotonic()
+        data_serialized = b64encode(pickle.dumps(data)).decode("ascii")
+        weechat.hook_process(
+            "func:" + get_callback_name(download_image_bg),
+            # The download itself stops at the timeout, so give the process
+            # some time to report that
+            round(data.timeout * 1000) + 5000,
+            get_callback_name(download_image_cb),
+            data_serialized,
+        )
+
+
 def download_image(
-    url: str, save_path: str, callback: Callable[[str], None], callback_data: str
+    url: str,
+    save_path: str,
+    callback: Callable[[str, Optional[str]], None],
+    callback_data: str,
+    quiet: bool,
 ):
-    data = DownloadImageData(callback, callback_data)
-    data_serialized = b64encode(pickle.dumps(data)).decode("ascii")
-    weechat.hook_process_hashtable(
-        f"url:{url}",
-        {"file_out": save_path},
-        60000,
-        get_callback_name(download_image_cb),
-        data_serialized,
+    data = DownloadImageData(
+        url,
+        save_path,
+        round(config_get_float("download_max_size") * 1024 * 1024),
+        config_get_float("download_timeout"),
+        callback,
+        callback_data,
+        quiet,
+        get_download_proxy(),
     )
+    download_queue.append(data)
+    start_downloads()
@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Collection, Dict, Iterable, Optional, Tuple
+
+import weechat
+
+from weechat_icat.config import config_get_float
+from weechat_icat.log import print_error
+from weechat_icat.shared import shared
+from weechat_icat.util import get_callback_name
+
+# How long to wait before saving the index after only the last used times
+# have changed, so a cache hit doesn't write the whole index
+SAVE_DELAY_MS = 60 * 1000
+
+
+@dataclass
+class DownloadCacheEntry:
+    size: int
+    last_used: float
+
+
+@dataclass
+class DownloadCache:
+    urls: Dict[str, str]
+    entries: Dict[str, DownloadCacheEntry]
+    # Set while a save of the index is scheduled
+    save_timer_hook: str = ""
+
+
+download_cache = DownloadCache({}, {})
+# Set when the index is loaded, so background jobs know the directory without
+# calling WeeChat
+download_cache_dir = ""
+# Hashes by path, size and modification time, so a job which needs the hash of
+# a file for several caches only reads it once
+file_hashes: Dict[Tuple[str, int, int], str] = {}
+
+
+def get_download_cache_path(name: str = ""):
+    path = weechat.string_eval_path_home(
+        shared.cache_downloaded_images_path, {}, {}, {}
+    )
+    return os.path.join(path, name) if name else path
+
+
+def get_file_hash(path: str):
+    # Downloaded files are already named by their hash
+    name = os.path.basename(path)
+    if (
+        download_cache_dir
+        and os.path.dirname(os.path.abspath(path)) == download_cache_dir
+        and re.fullmatch(r"[0-9a-f]{64}", name)
+    ):
+        return name
+
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in file_hashes:
+        # The render worker runs many jobs, so don't let this grow forever
+        if len(file_hashes) >= 1000:
+            file_hashes.clear()
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                file_hash.update(chunk)
+        file_hashes[key] = file_hash.hexdigest()
+    return file_hashes[key]
+
+
+def parse_download_cache_index(index: Any):
+    cache = DownloadCache({}, {})
+    for content_hash, entry in index["entries"].items():
+        cache.entries[str(content_hash)] = DownloadCacheEntry(
+            int(entry["size"]), float(entry["last_used"])
+        )
+    for url, content_hash in index["urls"].items():
+        if content_hash in cache.entries:
+            cache.urls[str(url)] = str(content_hash)
+    return cache
+
+
+def rebuild_download_cache():
+    # Keep the downloaded files which are named by their hash, but since it's
+    # unknown which urls they were downloaded from, they can only be evicted
+    cache = DownloadCache({}, {})
+    cache_path = get_download_cache_path()
+    for name in os.listdir(cache_path):
+        path = os.path.join(cache_path, name)
+        if not os.path.isfile(path) or name == "index.json":
+            continue
+        if re.fullmatch(r"[0-9a-f]{64}", name):
+            stat = os.stat(path)
+            cache.entries[name] = DownloadCacheEntry(stat.st_size, stat.st_mtime)
+        else:
+            os.remove(path)
+    return cache
+
+
+def load_download_cache():
+    global download_cache, download_cache_dir
+    download_cache_dir = os.path.abspath(get_download_cache_path())
+    index_path = get_download_cache_path("index.json")
+    try:
+        with open(index_path, encoding="utf-8") as f:
+            download_cache = parse_download_cache_index(json.load(f))
+    except FileNotFoundError:
+        download_cache = rebuild_download_cache()
+    except (ValueError, KeyError, TypeError, AttributeError):
+        print_error("download cache index is corrupt, rebuilding it")
+        download_cache = rebuild_download_cache()
+
+    # No downloads are running yet, so partial files are left from earlier
+    # sessions which exited while downloading
+    cache_path = get_download_cache_path()
+    for name in os.listdir(cache_path):
+        if name.endswith(".part"):
+            os.remove(os.path.join(cache_path, name))
+
+    for content_hash in list(download_cache.entries):
+        if not os.path.isfile(get_download_cache_path(content_hash)):
+            remove_download_cache_entry(content_hash)
+    evict_download_cache()
+    save_download_cache()
+
+
+def save_download_cache():
+    if download_cache.save_timer_hook:
+        weechat.unhook(download_cache.save_timer_hook)
+        download_cache.save_timer_hook = ""
+
+    index = {
+        "urls": download_cache.urls,
+        "entries": {
+            content_hash: {"size": entry.size, "last_used": entry.last_used}
+            for content_hash, entry in download_cache.entries.items()
+        },
+    }
+    index_path = get_download_cache_path("index.json")
+    with open(f"{index_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(index, f)
+    os.replace(f"{index_path}.tmp", index_path)
+
+
+def save_download_cache_timer_cb(data: str, remaining_calls: int) -> int:
+    download_cache.save_timer_hook = ""
+    save_download_cache()
+    return weechat.WEECHAT_RC_OK
+
+
+def save_download_cache_later():
+    if not download_cache.save_timer_hook:
+        download_cache.save_timer_hook = weechat.hook_timer(
+            SAVE_DELAY_MS, 0, 1, get_callback_name(save_download_cache_timer_cb), ""
+        )
+
+
+def flush_download_cache():
+    # Called when the script is unloaded, so a scheduled save isn't lost
+    if download_cache.save_timer_hook:
+        save_download_cache()
+
+
+def remove_download_cache_entry(content_hash: str):
+    del download_cache.entries[content_hash]
+    for url in [u for u, h in download_cache.urls.items() if h == content_hash]:
+        del download_cache.urls[url]
+    try:
+        os.remove(get_download_cache_path(content_hash))
+    except FileNotFoundError:
+        pass
+
+
+def evict_download_cache(keep: Collection[str] = ()):
+    # The hashes in keep are never evicted, but their size still counts
+    max_size = config_get_float("download_cache_max_size") * 1024 * 1024
+    max_age = config_get_float("download_cache_max_age") * 24 * 60 * 60
+    oldest_allowed = time.time() - max_age
+
+    entries_lru = sorted(
+        download_cache.entries.items(), key=lambda item: item[1].last_used
+    )
+    total_size = sum(entry.size for entry in download_cache.entries.values())
+    for content_hash, entry in entries_lru:
+        if total_size <= max_size and entry.last_used >= oldest_allowed:
+            break
+        if content_hash in keep:
+            continue
+        remove_download_cache_entry(content_hash)
+        total_size -= entry.size
+
+
+def get_cached_download(url: str) -> Optional[str]:
+    content_hash = download_cache.urls.get(url)
+    if content_hash is None:
+        return None
+
+    path = get_download_cache_path(content_hash)
+    if not os.path.isfile(path):
+        remove_download_cache_entry(content_hash)
+        save_download_cache()
+        return None
+
+    download_cache.entries[content_hash].last_used = time.time()
+    save_download_cache_later()
+    return path
+
+
+def add_cached_download(
+    url: str, downloaded_path: str, content_hash: str, paths_in_use: Iterable[str] = ()
+):
+    # The hash is computed by the download job, while downloading. The added
+    # file is about to be displayed, so it's not evicted, and neither are the
+    # files in paths_in_use, which may be needed to restore images.
+    path = get_download_cache_path(content_hash)
+    os.replace(downloaded_path, path)
+
+    download_cache.urls[url] = content_hash
+    download_cache.entries[content_hash] = DownloadCacheEntry(
+        os.path.getsize(path), time.time()
+    )
+    cache_path = get_download_cache_path()
+    keep = {content_hash}
+    keep.update(
+        os.path.basename(path_in_use)
+        for path_in_use in paths_in_use
+        if os.path.dirname(path_in_use) == cache_path
+    )
+    evict_download_cache(keep)
+    save_download_cache()
+    return path
@@ -1,9 +1,51 @@
 from __future__ import annotations
 
+import importlib
 import io
+import sys
+import zlib
 from dataclasses import dataclass
+from typing import TYPE_CHECKING, Generator, Optional, Tuple
 
-from PIL import Image
+from weechat_icat.metrics import measure_latency
+from weechat_icat.thumbnail_cache import open_image_for_size
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# Pillow is imported in the functions which use it instead of here, since it
+# takes a while to import and isn't needed until an image is displayed
+
+# Values for the f key in the kitty graphics protocol
+IMAGE_FORMAT_RGB = 24
+IMAGE_FORMAT_RGBA = 32
+IMAGE_FORMAT_PNG = 100
+
+
+def import_pillow():
+    # Background jobs are forked from WeeChat, so import Pillow in WeeChat
+    # before starting them, or each job would have to import it again
+    importlib.import_module("PIL.Image")
+
+
+def is_unidentified_image_error(error: Exception):
+    # If Pillow hasn't been imported, the error can't be one of its exceptions
+    pil = sys.modules.get("PIL")
+    return pil is not None and isinstance(error, pil.UnidentifiedImageError)
+
+
+def get_resample_filter(resample: str):
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    resample_filters = {
+        "nearest": Image.Resampling.NEAREST,
+        "box": Image.Resampling.BOX,
+        "bilinear": Image.Resampling.BILINEAR,
+        "hamming": Image.Resampling.HAMMING,
+        "bicubic": Image.Resampling.BICUBIC,
+        "lanczos": Image.Resampling.LANCZOS,
+    }
+    return resample_filters.get(resample, Image.Resampling.LANCZOS)
 
 
 @dataclass
@@ -11,10 +53,146 @@ class ImageData:
     data: bytes
     width: int
     height: int
+    format: int = IMAGE_FORMAT_PNG
+    compressed: bool = False
+    # Set when data is the unmodified contents of the file at this path
+    source_path: Optional[str] = None
+
+
+def get_image_size(path: str) -> Tuple[int, int]:
+    from PIL import Image  # pylint: disable=import-outside-toplevel
 
+    # Image.open only reads the header, the pixel data isn't decoded until needed
+    with Image.open(path) as im:
+        return im.size
 
-def load_image_data(path: str):
+
+def encode_image_png(im: Image.Image):
     with io.BytesIO() as data:
-        with Image.open(path) as im:
-            im.save(data, "png")
-            return ImageData(data.getvalue(), im.width, im.height)
+        im.save(data, "png")
+        return ImageData(data.getvalue(), im.width, im.height)
+
+
+def encode_image_raw(im: Image.Image, compression_level: int):
+    has_alpha = im.mode in ("RGBA", "LA", "PA") or "transparency" in im.info
+    mode = "RGBA" if has_alpha else "RGB"
+    with im.convert(mode) if im.mode != mode else im.copy() as im_converted:
+        data = zlib.compress(im_converted.tobytes(), compression_level)
+    image_format = IMAGE_FORMAT_RGBA if has_alpha else IMAGE_FORMAT_RGB
+    return ImageData(data, im.width, im.height, image_format, compressed=True)
+
+
+def encode_image(im: Image.Image, image_format: str, compression_level: int):
+    if image_format == "png":
+        return encode_image_png(im)
+    else:
+        return encode_image_raw(im, compression_level)
+
+
+def resize_and_encode_image(
+    im: Image.Image,
+    max_size: Optional[Tuple[int, int]],
+    resample: str,
+    image_format: str,
+    compression_level: int,
+):
+    with measure_latency("encode") as trace_fields:
+        if max_size and (im.width > max_size[0] or im.height > max_size[1]):
+            size = (min(im.width, max_size[0]), min(im.height, max_size[1]))
+            resample_filter = get_resample_filter(resample)
+            # The size parameter of resize is partially unknown in the stubs
+            with im.resize(  # pyright: ignore[reportUnknownMemberType]
+                size, resample_filter
+            ) as im_resized:
+                image_data = encode_image(im_resized, image_format, compression_level)
+        else:
+            image_data = encode_image(im, image_format, compression_level)
+        trace_fields.update(
+            width=image_data.width,
+            height=image_data.height,
+            payload_bytes=len(image_data.data),
+        )
+    return image_data
+
+
+def get_frame_gap(im: Image.Image) -> int:
+    # Like browsers, treat very short durations as unspecified
+    duration = int(im.info.get("duration") or 0)
+    return duration if duration > 10 else 100
+
+
+def load_animation_frames(
+    path: str,
+    max_size: Optional[Tuple[int, int]] = None,
+    resample: str = "lanczos",
+    image_format: str = "png",
+    compression_level: int = 6,
+) -> Generator[Tuple[int, Optional[ImageData]], None, None]:
+    # Yields the gap in milliseconds after each frame and its data, decoding
+    # one frame at a time. The data of the first frame is None, since that is
+    # sent by load_image_data. Nothing is yielded for still images.
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    with Image.open(path) as im:
+        if not getattr(im, "is_animated", False):
+            return
+        yield get_frame_gap(im), None
+        for index in range(1, getattr(im, "n_frames", 1)):
+            with measure_latency("decode", path=path, frame=index):
+                im.seek(index)
+                im.load()
+            yield get_frame_gap(im), resize_and_encode_image(
+                im, max_size, resample, image_format, compression_level
+            )
+
+
+def load_image_data(
+    path: str,
+    max_size: Optional[Tuple[int, int]] = None,
+    resample: str = "lanczos",
+    image_format: str = "png",
+    compression_level: int = 6,
+    thumbnail_cache_path: Optional[str] = None,
+    thumbnail_cache_max_size: int = 0,
+):
+    # image_format is png, raw or auto. With auto, PNG files which don't have
+    # to be resized are sent as is, and other images are sent as raw pixels,
+    # since compressing those with zlib is cheaper than encoding a PNG.
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    with Image.open(path) as im:
+        if max_size and (im.width > max_size[0] or im.height > max_size[1]):
+            # The terminal stretches the image to fill the cells anyway, so
+            # each dimension can be reduced independently
+            size = (min(im.width, max_size[0]), min(im.height, max_size[1]))
+            with measure_latency("decode", path=path, width=im.width, height=im.height):
+                if thumbnail_cache_path and thumbnail_cache_max_size > 0:
+                    im_source = open_image_for_size(
+                        path, im, size, thumbnail_cache_path, thumbnail_cache_max_size
+                    )
+                else:
+                    # Lets JPEG decode directly to a reduced scale
+                    im.draft(im.mode, size)
+                    im_source = im
+                im_source.load()
+            try:
+                return resize_and_encode_image(
+                    im_source, size, resample, image_format, compression_level
+                )
+            finally:
+                if im_source is not im:
+                    im_source.close()
+
+        if im.format == "PNG" and image_format in ("png", "auto"):
+            # The terminal decodes PNG itself, so send the file as is instead
+            # of decoding and encoding it again
+            with measure_latency(
+                "decode", path=path, width=im.width, height=im.height
+            ), open(path, "rb") as f:
+                return ImageData(f.read(), im.width, im.height, source_path=path)
+
+        with measure_latency("decode", path=path, width=im.width, height=im.height):
+            im.load()
+        return resize_and_encode_image(
+            im, None, resample, image_format, compression_level
+        )
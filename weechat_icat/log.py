@@ -14,6 +14,6 @@ def print_info(message: str):
     print_log("", message)
 
 
-def print_error(message: str):
-    if shared.print_errors:
+def print_error(message: str, quiet: bool = False):
+    if not quiet:
         print_log(weechat.prefix("error"), message)
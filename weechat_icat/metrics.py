@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import DefaultDict, Dict, Generator, List, Optional
+
+# Upper bounds in seconds of the buckets of the latency histograms. The last
+# bucket counts everything above the largest bound.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+@dataclass
+class LatencyHistogram:
+    bucket_counts: List[int] = field(
+        default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1)
+    )
+    count: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+
+@dataclass
+class Metrics:
+    latencies: DefaultDict[str, LatencyHistogram] = field(
+        default_factory=lambda: defaultdict(LatencyHistogram)
+    )
+    counters: DefaultDict[str, int] = field(default_factory=lambda: defaultdict(int))
+
+
+@dataclass
+class JobTrace:
+    job: str
+    job_id: str
+    fd: int
+
+
+process_metrics = Metrics()
+# Metrics are recorded here, which is replaced while running a background job
+current_metrics = process_metrics
+# Set while running a background job with tracing enabled
+job_trace: Optional[JobTrace] = None
+
+
+def add_latency(histogram: LatencyHistogram, seconds: float):
+    index = next(
+        (i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound),
+        len(LATENCY_BUCKETS),
+    )
+    histogram.bucket_counts[index] += 1
+    histogram.count += 1
+    histogram.total_seconds += seconds
+    histogram.max_seconds = max(histogram.max_seconds, seconds)
+
+
+def record_latency(name: str, seconds: float):
+    add_latency(current_metrics.latencies[name], seconds)
+
+
+def write_trace_event(
+    stage: str, start_time: float, seconds: float, fields: Dict[str, object]
+):
+    if job_trace is None:
+        return
+    event = {
+        "time": start_time,
+        "duration": seconds,
+        "job": job_trace.job,
+        "job_id": job_trace.job_id,
+        "pid": os.getpid(),
+        "stage": stage,
+        **fields,
+    }
+    # Several jobs may write concurrently, so write each event in one write
+    # to the file opened for appending, which keeps the lines whole
+    os.write(job_trace.fd, (json.dumps(event) + "\n").encode())
+
+
+@contextmanager
+def measure_latency(
+    name: str, **fields: object
+) -> Generator[Dict[str, object], None, None]:
+    # The fields are added to the trace event of the stage, and more can be
+    # added to the yielded dict
+    start_time = time.time()
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        seconds = time.perf_counter() - start
+        record_latency(name, seconds)
+        write_trace_event(name, start_time, seconds, fields)
+
+
+def count_metric(name: str, value: int = 1):
+    current_metrics.counters[name] += value
+
+
+@contextmanager
+def collect_job_metrics(
+    job: str,
+    job_id: str,
+    trace_path: str = "",
+    profile_path: str = "",
+    **fields: object,
+) -> Generator[Metrics, None, None]:
+    # Background jobs run in other processes, so their metrics are collected
+    # separately and passed back with the result, to be merged with
+    # merge_metrics in the main process. If trace_path is set, an event for
+    # each stage and one with fields for the whole job are appended to it,
+    # and if profile_path is set, a profile of the job is written there.
+    global current_metrics, job_trace
+    previous_metrics = current_metrics
+    current_metrics = Metrics()
+    if trace_path:
+        fd = os.open(trace_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        job_trace = JobTrace(job, job_id, fd)
+    profile = None
+    if profile_path:
+        import cProfile  # pylint: disable=import-outside-toplevel
+
+        profile = cProfile.Profile()
+    start_time = time.time()
+    start = time.perf_counter()
+    if profile:
+        profile.enable()
+    try:
+        yield current_metrics
+    finally:
+        seconds = time.perf_counter() - start
+        if profile:
+            profile.disable()
+            os.makedirs(profile_path, exist_ok=True)
+            profile.dump_stats(os.path.join(profile_path, f"{job}-{job_id}.prof"))
+        if job_trace:
+            # The counters include the bytes written to the terminal and the
+            # cache hits and misses of the job
+            fields.update(current_metrics.counters)
+            write_trace_event("job", start_time, seconds, fields)
+            os.close(job_trace.fd)
+            job_trace = None
+        current_metrics = previous_metrics
+
+
+def merge_metrics(metrics: Metrics):
+    for name, histogram in metrics.latencies.items():
+        merged = process_metrics.latencies[name]
+        for index, bucket_count in enumerate(histogram.bucket_counts):
+            merged.bucket_counts[index] += bucket_count
+        merged.count += histogram.count
+        merged.total_seconds += histogram.total_seconds
+        merged.max_seconds = max(merged.max_seconds, histogram.max_seconds)
+    for name, value in metrics.counters.items():
+        process_metrics.counters[name] += value
@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import pickle
+import re
+from typing import List, Optional
+
+from weechat_icat.download_cache import get_file_hash
+
+
+def get_payload_cache_key(path: str, *parameters: object):
+    # Everything which changes the bytes sent to the terminal, except for the
+    # image id which is replaced when the payload is used
+    key = "-".join([get_file_hash(path), *map(str, parameters)])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def set_cmds_image_id(cmds: List[bytes], image_id: int):
+    # Only the commands which start an image, a frame or an animation control
+    # have the image id. The control data starts after _G and ends at the
+    # first semicolon after that, which matters when wrapped for tmux.
+    image_id_bytes = str(image_id).encode("ascii")
+    new_cmds: List[bytes] = []
+    for cmd in cmds:
+        control_data_start = cmd.find(b"_G") + 2
+        control_data_end = cmd.find(b";", control_data_start)
+        if control_data_end == -1:
+            control_data_end = len(cmd)
+        control_data = cmd[control_data_start:control_data_end]
+        if b"i=" in control_data:
+            control_data = re.sub(
+                rb"(^|,)i=\d+", rb"\g<1>i=" + image_id_bytes, control_data, count=1
+            )
+            cmd = cmd[:control_data_start] + control_data + cmd[control_data_end:]
+        new_cmds.append(cmd)
+    return new_cmds
+
+
+def read_cached_payload(cache_path: str, key: str) -> Optional[List[bytes]]:
+    path = os.path.join(cache_path, key)
+    try:
+        with open(path, "rb") as f:
+            cmds: List[bytes] = pickle.load(f)
+        # The modification time is used for evicting the least recently used
+        os.utime(path)
+        return cmds
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def evict_cache_dir(cache_path: str, max_size: int):
+    entries: List[os.stat_result] = []
+    names: List[str] = []
+    for name in os.listdir(cache_path):
+        if name.endswith(".tmp"):
+            continue
+        try:
+            entries.append(os.stat(os.path.join(cache_path, name)))
+            names.append(name)
+        except FileNotFoundError:
+            pass
+
+    total_size = sum(entry.st_size for entry in entries)
+    for entry, name in sorted(zip(entries, names), key=lambda e: e[0].st_mtime):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_path, name))
+        except FileNotFoundError:
+            pass
+        total_size -= entry.st_size
+
+
+def write_cached_payload(cache_path: str, key: str, cmds: List[bytes], max_size: int):
+    # Background jobs may run concurrently, so write to a unique file and
+    # replace atomically
+    path = os.path.join(cache_path, key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(cmds, f)
+    os.replace(tmp_path, path)
+    evict_cache_dir(cache_path, max_size)
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Set
+
+from weechat_icat.config import config_get_float
+from weechat_icat.terminal_graphics import ImagePlacement, free_image_id
+
+
+@dataclass
+class PlacementRegistry:
+    placements: Dict[str, List[ImagePlacement]]
+    # Placements by image id, ordered from least to most recently used
+    lru: OrderedDict[int, ImagePlacement]
+    # Image ids of the placements displayed in each buffer
+    buffer_image_ids: Dict[str, Set[int]]
+    payload_bytes: int = 0
+
+
+@dataclass
+class PlacementRegistryUsage:
+    placements: int
+    placements_with_payload: int
+    payload_bytes: int
+
+
+placement_registry = PlacementRegistry(
+    defaultdict(list), OrderedDict(), defaultdict(set)
+)
+
+
+def get_payload_size(image_placement: ImagePlacement):
+    return sum(map(len, image_placement.terminal_cmds))
+
+
+def enforce_placement_registry_budget():
+    # The payloads are dropped rather than the placements, since the
+    # placements are needed to restore the images, and the payloads can be
+    # read from the payload cache or created again when needed
+    max_bytes = config_get_float("placements_max_memory") * 1024 * 1024
+    for image_placement in placement_registry.lru.values():
+        if placement_registry.payload_bytes <= max_bytes:
+            break
+        placement_registry.payload_bytes -= get_payload_size(image_placement)
+        image_placement.terminal_cmds = []
+
+
+def register_image_placement(image_placement: ImagePlacement):
+    placement_registry.placements[image_placement.path].append(image_placement)
+    placement_registry.lru[image_placement.image_id] = image_placement
+    placement_registry.payload_bytes += get_payload_size(image_placement)
+    enforce_placement_registry_budget()
+
+
+def add_image_placement_buffer(buffer: str, image_placement: ImagePlacement):
+    placement_registry.buffer_image_ids[buffer].add(image_placement.image_id)
+
+
+def remove_buffer_image_placements(buffer: str):
+    placement_registry.buffer_image_ids.pop(buffer, None)
+
+
+def get_buffer_image_placements(buffer: str):
+    image_ids = placement_registry.buffer_image_ids.get(buffer, set())
+    return [
+        placement_registry.lru[image_id]
+        for image_id in image_ids
+        if image_id in placement_registry.lru
+    ]
+
+
+def is_image_placement_displayed(image_placement: ImagePlacement):
+    return any(
+        image_placement.image_id in image_ids
+        for image_ids in placement_registry.buffer_image_ids.values()
+    )
+
+
+def touch_image_placement(image_placement: ImagePlacement):
+    if image_placement.image_id in placement_registry.lru:
+        placement_registry.lru.move_to_end(image_placement.image_id)
+
+
+def set_image_placement_cmds(image_placement: ImagePlacement, cmds: List[bytes]):
+    placement_registry.payload_bytes -= get_payload_size(image_placement)
+    image_placement.terminal_cmds = cmds
+    placement_registry.payload_bytes += get_payload_size(image_placement)
+    touch_image_placement(image_placement)
+    enforce_placement_registry_budget()
+
+
+def unregister_image_placements(path: str):
+    for image_placement in placement_registry.placements.pop(path, []):
+        placement_registry.lru.pop(image_placement.image_id, None)
+        placement_registry.payload_bytes -= get_payload_size(image_placement)
+        free_image_id(image_placement.image_id)
+        for image_ids in placement_registry.buffer_image_ids.values():
+            image_ids.discard(image_placement.image_id)
+
+
+def get_image_placements(path: str) -> List[ImagePlacement]:
+    return placement_registry.placements.get(path, [])
+
+
+def get_image_placement(image_id: int):
+    return placement_registry.lru.get(image_id)
+
+
+def get_all_image_placements():
+    return list(placement_registry.lru.values())
+
+
+def get_image_placement_paths():
+    return list(placement_registry.placements)
+
+
+def get_placement_registry_usage():
+    return PlacementRegistryUsage(
+        len(placement_registry.lru),
+        sum(1 for ip in placement_registry.lru.values() if ip.terminal_cmds),
+        placement_registry.payload_bytes,
+    )
@@ -2,8 +2,16 @@ from __future__ import annotations
 
 import weechat
 
+from weechat_icat.auto_display import register_auto_display_hooks
+from weechat_icat.background import stop_render_worker
 from weechat_icat.commands import register_commands
+from weechat_icat.config import init_config
+from weechat_icat.download_cache import flush_download_cache, load_download_cache
+from weechat_icat.restore import register_restore_hooks
 from weechat_icat.shared import shared
+from weechat_icat.stats import register_stats_hooks
+from weechat_icat.terminal_info import init_terminal_info
+from weechat_icat.util import get_callback_name
 
 SCRIPT_AUTHOR = "Trygve Aaberge <trygveaa@gmail.com>"
 SCRIPT_LICENSE = "MIT"
@@ -11,12 +19,23 @@ SCRIPT_DESC = "Display images in the chat"
 
 
 def create_cache_paths():
-    paths = [shared.cache_path, shared.cache_downloaded_images_path]
+    paths = [
+        shared.cache_path,
+        shared.cache_downloaded_images_path,
+        shared.cache_payloads_path,
+        shared.cache_thumbnails_path,
+    ]
     for path in paths:
         if not weechat.mkdir_home(path, 0o755):
             raise RuntimeError("Failed creating cache path")
 
 
+def shutdown_cb() -> int:
+    stop_render_worker()
+    flush_download_cache()
+    return weechat.WEECHAT_RC_OK
+
+
 def register():
     if weechat.register(
         shared.SCRIPT_NAME,
@@ -24,8 +43,14 @@ def register():
         shared.SCRIPT_VERSION,
         SCRIPT_LICENSE,
         SCRIPT_DESC,
-        "",
+        get_callback_name(shutdown_cb),
         "",
     ):
+        init_config()
+        init_terminal_info()
         create_cache_paths()
+        load_download_cache()
         register_commands()
+        register_restore_hooks()
+        register_auto_display_hooks()
+        register_stats_hooks()
@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import pickle
+from base64 import b64decode, b64encode
+from dataclasses import dataclass
+from typing import List, Set
+
+import weechat
+
+from weechat_icat.log import print_error, print_info
+from weechat_icat.placements import (
+    get_all_image_placements,
+    get_buffer_image_placements,
+    get_image_placement,
+    is_image_placement_displayed,
+    remove_buffer_image_placements,
+)
+from weechat_icat.terminal_graphics import (
+    ImagePlacement,
+    ImagesSendFinished,
+    send_images_to_terminal,
+)
+from weechat_icat.util import get_callback_name
+
+
+@dataclass
+class RestoreState:
+    restore_id: int
+    buffer: str
+    pending: Set[int]
+    total: int
+    quiet: bool = False
+    restored: int = 0
+    failed: int = 0
+
+
+@dataclass
+class ImagesRestoredData:
+    restore_id: int
+    count: int
+
+
+restore_state = RestoreState(0, "", set(), 0)
+
+
+def get_displayed_buffers() -> List[str]:
+    buffers: List[str] = []
+    hdata = weechat.hdata_get("window")
+    window = weechat.hdata_get_list(hdata, "gui_windows")
+    while window:
+        buffers.append(weechat.hdata_pointer(hdata, window, "buffer"))
+        window = weechat.hdata_move(hdata, window, 1)
+    return buffers
+
+
+def images_restored_cb(data_serialized: str, result: ImagesSendFinished):
+    data: ImagesRestoredData = pickle.loads(b64decode(data_serialized))
+    if data.restore_id != restore_state.restore_id:
+        return
+
+    if isinstance(result, Exception):
+        print_error("failed restoring images:", restore_state.quiet)
+        raise result
+
+    restore_state.restored += data.count - len(result)
+    restore_state.failed += len(result)
+    if result:
+        print_error(
+            f"failed restoring {len(result)} images, first error: {result[0]}",
+            restore_state.quiet,
+        )
+    weechat.command(restore_state.buffer, "/window refresh")
+    done = restore_state.restored + restore_state.failed
+    if done >= restore_state.total and not restore_state.pending:
+        if restore_state.failed:
+            print_info(
+                f"finished restoring images, {restore_state.failed}/"
+                f"{restore_state.total} images couldn't be restored"
+            )
+        else:
+            print_info("finished restoring images")
+    else:
+        print_info(
+            f"restored {restore_state.restored}/{restore_state.total} images, the "
+            "rest are restored when their buffers are displayed"
+        )
+
+
+def restore_images(image_placements: List[ImagePlacement]):
+    data = ImagesRestoredData(restore_state.restore_id, len(image_placements))
+    data_serialized = b64encode(pickle.dumps(data)).decode("ascii")
+    send_images_to_terminal(image_placements, images_restored_cb, data_serialized)
+
+
+def restore_buffer_images(buffer: str):
+    image_placements = [
+        image_placement
+        for image_placement in get_buffer_image_placements(buffer)
+        if image_placement.image_id in restore_state.pending
+    ]
+    if image_placements:
+        restore_state.pending.difference_update(ip.image_id for ip in image_placements)
+        restore_images(image_placements)
+
+
+def start_restore(buffer: str, quiet: bool):
+    # Images which aren't displayed in any buffer can't be seen, so they
+    # don't have to be restored
+    image_ids = {
+        image_placement.image_id
+        for image_placement in get_all_image_placements()
+        if is_image_placement_displayed(image_placement)
+    }
+    restore_state.restore_id += 1
+    restore_state.buffer = buffer
+    restore_state.pending = image_ids
+    restore_state.total = len(image_ids)
+    restore_state.quiet = quiet
+    restore_state.restored = 0
+    restore_state.failed = 0
+
+    if not image_ids:
+        print_info("no images to restore")
+        return
+
+    for displayed_buffer in get_displayed_buffers():
+        restore_buffer_images(displayed_buffer)
+
+
+def cancel_restore():
+    if not restore_state.pending:
+        print_info("no restore in progress")
+        return
+    restore_state.restore_id += 1
+    restore_state.pending.clear()
+    print_info(
+        f"cancelled restoring images, restored {restore_state.restored}/"
+        f"{restore_state.total} images"
+    )
+
+
+def restore_buffer_switch_cb(data: str, signal: str, signal_data: str) -> int:
+    if restore_state.pending:
+        restore_buffer_images(signal_data)
+    return weechat.WEECHAT_RC_OK
+
+
+def restore_window_scrolled_cb(data: str, signal: str, signal_data: str) -> int:
+    if restore_state.pending:
+        restore_buffer_images(weechat.window_get_pointer(signal_data, "buffer"))
+    return weechat.WEECHAT_RC_OK
+
+
+def restore_buffer_closing_cb(data: str, signal: str, signal_data: str) -> int:
+    remove_buffer_image_placements(signal_data)
+    if restore_state.pending:
+        for image_id in list(restore_state.pending):
+            image_placement = get_image_placement(image_id)
+            if not image_placement or not is_image_placement_displayed(image_placement):
+                restore_state.pending.discard(image_id)
+                restore_state.total -= 1
+    return weechat.WEECHAT_RC_OK
+
+
+def register_restore_hooks():
+    weechat.hook_signal(
+        "buffer_switch", get_callback_name(restore_buffer_switch_cb), ""
+    )
+    weechat.hook_signal(
+        "window_scrolled", get_callback_name(restore_window_scrolled_cb), ""
+    )
+    weechat.hook_signal(
+        "buffer_closing", get_callback_name(restore_buffer_closing_cb), ""
+    )
@@ -13,7 +13,10 @@ class Shared:
         self.weechat_callbacks: Dict[str, Callable[..., WeechatCallbackReturnType]]
         self.cache_path = "${weechat_cache_dir}/icat"
         self.cache_downloaded_images_path = f"{self.cache_path}/downloaded_images"
-        self.print_errors = True
+        self.cache_payloads_path = f"{self.cache_path}/payloads"
+        self.cache_thumbnails_path = f"{self.cache_path}/thumbnails"
+        self.cache_profiles_path = f"{self.cache_path}/profiles"
+        self.job_trace_path = f"{self.cache_path}/job_trace.jsonl"
 
 
 shared = Shared()
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import json
+from typing import Dict, List
+
+import weechat
+
+from weechat_icat.background import background_jobs, is_render_worker_running
+from weechat_icat.download import download_queue, download_stats, downloads_running
+from weechat_icat.log import print_info
+from weechat_icat.metrics import LATENCY_BUCKETS, LatencyHistogram, process_metrics
+from weechat_icat.placements import get_placement_registry_usage
+from weechat_icat.restore import restore_state
+from weechat_icat.terminal_graphics import image_create_jobs, image_create_queue
+from weechat_icat.util import get_callback_name
+
+# The order the stages of creating an image happen in, which is the order
+# they are printed in
+LATENCY_ORDER = [
+    "download",
+    "queue_wait",
+    "fork_job",
+    "worker_job",
+    "decode",
+    "encode",
+    "transmit",
+]
+
+
+def get_stats_counters() -> Dict[str, int]:
+    counters = dict(sorted(process_metrics.counters.items()))
+    counters["downloads_coalesced"] = download_stats.coalesced
+    counters["downloads_rejected"] = download_stats.rejected
+    return counters
+
+
+def get_stats_gauges() -> Dict[str, int]:
+    placement_registry_usage = get_placement_registry_usage()
+    return {
+        "image_create_queue": len(image_create_queue),
+        "image_create_jobs": len(image_create_jobs),
+        "download_queue": len(download_queue),
+        "downloads_running": len(downloads_running),
+        "background_jobs": len(background_jobs),
+        "render_worker_running": int(is_render_worker_running()),
+        "restore_pending": len(restore_state.pending),
+        "placements": placement_registry_usage.placements,
+        "placements_with_payload": placement_registry_usage.placements_with_payload,
+        "placements_payload_bytes": placement_registry_usage.payload_bytes,
+    }
+
+
+def get_stats_latencies() -> Dict[str, LatencyHistogram]:
+    latencies = process_metrics.latencies
+    names = sorted(
+        latencies,
+        key=lambda name: (
+            LATENCY_ORDER.index(name) if name in LATENCY_ORDER else len(LATENCY_ORDER),
+            name,
+        ),
+    )
+    return {name: latencies[name] for name in names}
+
+
+def get_bucket_labels() -> List[str]:
+    return [f"{bound:g}" for bound in LATENCY_BUCKETS] + ["inf"]
+
+
+def get_stats_json() -> str:
+    bucket_labels = get_bucket_labels()
+    return json.dumps(
+        {
+            "counters": get_stats_counters(),
+            "gauges": get_stats_gauges(),
+            "latencies": {
+                name: {
+                    "count": histogram.count,
+                    "total_seconds": histogram.total_seconds,
+                    "max_seconds": histogram.max_seconds,
+                    # Number of latencies up to each bound in seconds, and
+                    # above the largest bound
+                    "buckets": dict(zip(bucket_labels, histogram.bucket_counts)),
+                }
+                for name, histogram in get_stats_latencies().items()
+            },
+        }
+    )
+
+
+def format_seconds(seconds: float):
+    if seconds < 1:
+        return f"{seconds * 1000:.1f}ms"
+    return f"{seconds:.2f}s"
+
+
+def format_latency(histogram: LatencyHistogram):
+    average = histogram.total_seconds / histogram.count if histogram.count else 0.0
+    bucket_labels = [f"<={format_seconds(bound)}" for bound in LATENCY_BUCKETS]
+    bucket_labels.append(f">{format_seconds(LATENCY_BUCKETS[-1])}")
+    buckets = " ".join(
+        f"{label}:{count}"
+        for label, count in zip(bucket_labels, histogram.bucket_counts)
+        if count
+    )
+    return (
+        f"{histogram.count} times, average {format_seconds(average)}, "
+        f"max {format_seconds(histogram.max_seconds)} ({buckets})"
+    )
+
+
+def print_stats():
+    counters = get_stats_counters()
+    gauges = get_stats_gauges()
+    print_info("stats:")
+    for name, histogram in get_stats_latencies().items():
+        print_info(f"  {name} latency: {format_latency(histogram)}")
+    print_info("  " + ", ".join(f"{name}={value}" for name, value in counters.items()))
+    print_info("  " + ", ".join(f"{name}={value}" for name, value in gauges.items()))
+
+
+def stats_info_cb(data: str, info_name: str, arguments: str) -> str:
+    return get_stats_json()
+
+
+def stats_infolist_cb(data: str, infolist_name: str, pointer: str, arguments: str):
+    # The values are strings, since integer variables are only 32 bits
+    infolist = weechat.infolist_new()
+    metrics = [
+        *(("counter", name, value) for name, value in get_stats_counters().items()),
+        *(("gauge", name, value) for name, value in get_stats_gauges().items()),
+    ]
+    for metric_type, name, value in metrics:
+        item = weechat.infolist_new_item(infolist)
+        weechat.infolist_new_var_string(item, "type", metric_type)
+        weechat.infolist_new_var_string(item, "name", name)
+        weechat.infolist_new_var_string(item, "value", str(value))
+    for name, histogram in get_stats_latencies().items():
+        item = weechat.infolist_new_item(infolist)
+        weechat.infolist_new_var_string(item, "type", "latency")
+        weechat.infolist_new_var_string(item, "name", name)
+        weechat.infolist_new_var_string(item, "value", str(histogram.count))
+        weechat.infolist_new_var_string(
+            item, "total_seconds", str(histogram.total_seconds)
+        )
+        weechat.infolist_new_var_string(item, "max_seconds", str(histogram.max_seconds))
+        weechat.infolist_new_var_string(
+            item, "buckets", ",".join(map(str, histogram.bucket_counts))
+        )
+    return infolist
+
+
+def register_stats_hooks():
+    weechat.hook_info(
+        "icat_stats",
+        "runtime metrics of icat, as a JSON object with counters, gauges and "
+        "latency histograms",
+        "",
+        get_callback_name(stats_info_cb),
+        "",
+    )
+    weechat.hook_infolist(
+        "icat_stats",
+        "runtime metrics of icat, one item per metric with the variables type "
+        "(counter, gauge or latency), name and value; latencies also have "
+        "total_seconds, max_seconds and buckets (counts up to "
+        + ", ".join(get_bucket_labels()[:-1])
+        + " seconds and above)",
+        "",
+        "",
+        get_callback_name(stats_infolist_cb),
+        "",
+    )
@@ -1,34 +1,78 @@
 from __future__ import annotations
 
-import array
 import fcntl
 import os
 import pickle
-import termios
+import tempfile
+import time
 from base64 import b64decode, b64encode
 from collections import defaultdict
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
 from io import StringIO
 from random import randint
-from typing import Callable, Dict, List, Optional, Union
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
 from uuid import UUID, uuid4
 
 import weechat
 
-from weechat_icat.image import ImageData, load_image_data
+from weechat_icat.background import (
+    background_job,
+    read_background_result,
+    remove_background_result,
+    run_in_background,
+    write_background_result,
+)
+from weechat_icat.config import (
+    config_get_bool,
+    config_get_float,
+    config_get_int,
+    config_get_str,
+)
+from weechat_icat.image import (
+    IMAGE_FORMAT_PNG,
+    ImageData,
+    get_image_size,
+    import_pillow,
+    load_animation_frames,
+    load_image_data,
+)
+from weechat_icat.log import print_info
+from weechat_icat.metrics import (
+    Metrics,
+    collect_job_metrics,
+    count_metric,
+    measure_latency,
+    merge_metrics,
+    record_latency,
+)
+from weechat_icat.payload_cache import (
+    get_payload_cache_key,
+    read_cached_payload,
+    set_cmds_image_id,
+    write_cached_payload,
+)
+from weechat_icat.shared import shared
 from weechat_icat.terminal_graphics_diacritics import rowcolumn_diacritics_chars
-from weechat_icat.util import get_callback_name
+from weechat_icat.terminal_info import (
+    DEFAULT_CELL_HEIGHT,
+    DEFAULT_CELL_WIDTH,
+    terminal_info,
+)
+
+# Chunks of raw data which become 4096 bytes, the maximum chunk size, when
+# base64 encoded
+GR_CHUNK_SIZE_RAW = 3072
+TTY_BUFFER_SIZE = 1024 * 1024
+PLACEHOLDER_CHAR = "\U0010eeee"
+# 256 values for each of the upper and lower 8 bits, except for 0
+MAX_IMAGE_IDS = 256 * 256 - 1
 
 string_buffers: Dict[str, StringIO] = defaultdict(StringIO)
 image_create_queue: List[ImageCreateData] = []
-
-
-@dataclass
-class TerminalSize:
-    rows: int
-    columns: int
-    width: int
-    height: int
+image_create_jobs: Dict[UUID, ImageCreateData] = {}
+image_ids_in_use: Set[int] = set()
+freed_image_ids: List[int] = []
 
 
 @dataclass
@@ -40,8 +84,33 @@ class ImagePlacement:
     terminal_cmds: List[bytes] = field(default_factory=list)
 
 
+@dataclass
+class ImageSendOptions:
+    cell_width: float
+    cell_height: float
+    downscale: bool
+    downscale_resample: str
+    downscale_max_oversampling: float
+    transmission_format: str
+    transmission_compression_level: int
+    transmission_medium: str
+    payload_cache_path: str
+    payload_cache_max_size: int
+    thumbnail_cache_path: str
+    thumbnail_cache_max_size: int
+    animation_max_frames: int
+    animation_max_size: int
+    # 0 if progressive preview is disabled
+    preview_size: int
+    # Empty if tracing or profiling of background jobs is disabled
+    job_trace_path: str
+    job_profile_path: str
+
+
 ImageCreateFinished = Union[ImagePlacement, Exception]
-ImagesSendFinished = Union[None, Exception]
+# The errors of the images which couldn't be sent, or the error if the whole
+# job failed
+ImagesSendFinished = Union[List[str], Exception]
 
 
 @dataclass
@@ -50,116 +119,304 @@ class ImageCreateData:
     image_id: int
     columns: Optional[int]
     rows: Optional[int]
-    terminal_size: TerminalSize
+    send_options: ImageSendOptions
     image_placement: Optional[ImagePlacement]
     callback: Callable[[str, ImageCreateFinished, bool], None]
     callback_data: str
-    uuid: UUID = uuid4()
+    uuid: UUID = field(default_factory=uuid4)
+    # Whether this job sends a preview, or the full image after a preview
+    preview: bool = False
+    previewed: bool = False
+    queued_time: float = field(default_factory=time.monotonic)
+    # When this job was added to image_create_queue
+    wait_start_time: float = field(default_factory=time.monotonic)
 
 
 @dataclass
 class ImagesSendData:
     image_placements: List[ImagePlacement]
+    send_options: ImageSendOptions
     callback: Callable[[str, ImagesSendFinished], None]
     callback_data: str
-    uuid: UUID = uuid4()
+    uuid: UUID = field(default_factory=uuid4)
 
 
-def get_terminal_size():
-    buf = array.array("H", [0, 0, 0, 0])
-    fcntl.ioctl(1, termios.TIOCGWINSZ, buf)
-    return TerminalSize(*buf)
+@dataclass
+class ImageCreateBurst:
+    start_time: float = 0.0
+    images_created: int = 0
+    bytes_sent: int = 0
+    # Sums of the time from queueing each image until something is shown,
+    # which is the preview if enabled, and until the full image is shown
+    first_pixel_seconds: float = 0.0
+    full_image_seconds: float = 0.0
+
+
+image_create_burst = ImageCreateBurst()
+
+
+def get_image_send_options():
+    return ImageSendOptions(
+        terminal_info.cell_width,
+        terminal_info.cell_height,
+        config_get_bool("downscale"),
+        config_get_str("downscale_resample"),
+        max(1.0, config_get_float("downscale_max_oversampling")),
+        config_get_str("transmission_format"),
+        min(9, max(0, config_get_int("transmission_compression_level"))),
+        get_transmission_medium(),
+        weechat.string_eval_path_home(shared.cache_payloads_path, {}, {}, {}),
+        round(config_get_float("payload_cache_max_size") * 1024 * 1024),
+        weechat.string_eval_path_home(shared.cache_thumbnails_path, {}, {}, {}),
+        round(config_get_float("thumbnail_cache_max_size") * 1024 * 1024),
+        config_get_int("animation_max_frames") if config_get_bool("animations") else 1,
+        round(config_get_float("animation_max_size") * 1024 * 1024),
+        (
+            max(1, config_get_int("progressive_preview_size"))
+            if config_get_bool("progressive_preview")
+            else 0
+        ),
+        (
+            weechat.string_eval_path_home(shared.job_trace_path, {}, {}, {})
+            if config_get_bool("trace_jobs")
+            else ""
+        ),
+        (
+            weechat.string_eval_path_home(shared.cache_profiles_path, {}, {}, {})
+            if config_get_bool("profile_jobs")
+            else ""
+        ),
+    )
 
 
-def get_random_image_id():
-    image_id_upper = randint(0, 255)
-    image_id_lower = randint(0, 255)
-    return (image_id_upper << 24) + image_id_lower
+def get_transmission_medium():
+    medium = config_get_str("transmission_medium")
+    if medium not in ("file", "temp_file", "shared_memory", "auto"):
+        return "direct"
+    if not terminal_info.local:
+        return "direct"
+    if medium == "auto":
+        return "file"
+    if medium == "shared_memory" and not os.path.isdir("/dev/shm"):
+        return "temp_file"
+    return medium
+
+
+def get_image_max_size(
+    image_placement: ImagePlacement, send_options: ImageSendOptions
+) -> Optional[Tuple[int, int]]:
+    if (
+        not send_options.downscale
+        or not send_options.cell_width
+        or not send_options.cell_height
+    ):
+        return None
+    oversampling = send_options.downscale_max_oversampling
+    return (
+        max(1, round(image_placement.columns * send_options.cell_width * oversampling)),
+        max(1, round(image_placement.rows * send_options.cell_height * oversampling)),
+    )
 
 
-def serialize_gr_command(control_data: Dict[str, Union[str, int]], payload: bytes):
-    tmux = weechat.string_eval_expression("${env:TMUX}", {}, {}, {})
+def allocate_image_id():
+    # The lower 8 bits of the id are encoded in the 256 color foreground
+    # color and the upper 8 bits in the third diacritic of the placeholder.
+    # 24-bit ids encoded in a true color foreground would give more ids, but
+    # WeeChat only outputs 256 colors, so only 65535 ids are available.
+    while freed_image_ids:
+        image_id = freed_image_ids.pop()
+        if image_id not in image_ids_in_use:
+            image_ids_in_use.add(image_id)
+            return image_id
+
+    if len(image_ids_in_use) >= MAX_IMAGE_IDS:
+        raise RuntimeError("all image ids are in use")
+
+    # Pick ids randomly to make collisions with images from other
+    # processes or earlier sessions in the same terminal less likely
+    while True:
+        image_id = (randint(0, 255) << 24) + randint(0, 255)
+        if image_id != 0 and image_id not in image_ids_in_use:
+            image_ids_in_use.add(image_id)
+            return image_id
+
+
+def free_image_id(image_id: int):
+    if image_id in image_ids_in_use:
+        image_ids_in_use.remove(image_id)
+        freed_image_ids.append(image_id)
+
+
+def is_tmux():
+    return terminal_info.tmux
+
+
+def get_gr_command_framing(tmux: bool):
     esc = b"\033\033" if tmux else b"\033"
+    start = (b"\033Ptmux;" if tmux else b"") + esc + b"_G"
+    end = esc + b"\\" + (b"\033\\" if tmux else b"")
+    return start, end
+
+
+def serialize_gr_command(control_data: Dict[str, Union[str, int]], payload: bytes):
+    start, end = get_gr_command_framing(is_tmux())
     control_data_str = ",".join(f"{k}={v}" for k, v in control_data.items())
     ans = [
-        b"\033Ptmux;" if tmux else b"",
-        esc + b"_G",
+        start,
         control_data_str.encode("ascii"),
         b";" + payload if payload else b"",
-        esc + b"\\",
-        b"\033\\" if tmux else b"",
+        end,
     ]
     return b"".join(ans)
 
 
+def open_tty():
+    # Buffer the output so the commands are written in large writes instead
+    # of one write per chunk
+    tty = open(os.ctermid(), "wb", buffering=TTY_BUFFER_SIZE)
+    # Several jobs may write concurrently, so lock the tty to prevent the
+    # chunks of different images from being interleaved.
+    fcntl.flock(tty, fcntl.LOCK_EX)
+    return tty
+
+
 def write_chunked(control_data: Dict[str, Union[str, int]], data: bytes):
     cmds: List[bytes] = []
-    with open(os.ctermid(), "wb") as tty:
-        data_base64 = b64encode(data)
-        while data_base64:
-            chunk, data_base64 = data_base64[:4096], data_base64[4096:]
-            m = 1 if data_base64 else 0
-            cmd = serialize_gr_command({**control_data, "m": m}, chunk)
-            cmds.append(cmd)
-            tty.write(cmd)
-            tty.flush()
-            control_data.clear()
+    start, end = get_gr_command_framing(is_tmux())
+    control_data_str = ",".join(f"{k}={v}" for k, v in control_data.items())
+    first_control_data = (
+        f"{control_data_str},".encode("ascii") if control_data_str else b""
+    )
+    data_view = memoryview(data)
+    # Encode each chunk separately from a view of the data instead of
+    # slicing the whole base64 encoded data, which copies the remaining data
+    # for each chunk
+    for offset in range(0, len(data), GR_CHUNK_SIZE_RAW):
+        chunk = b64encode(data_view[offset : offset + GR_CHUNK_SIZE_RAW])
+        m = b"m=1" if offset + GR_CHUNK_SIZE_RAW < len(data) else b"m=0"
+        cmd = b"".join((start, first_control_data, m, b";", chunk, end))
+        cmds.append(cmd)
+        first_control_data = b""
+    write_terminal_cmds(cmds)
     return cmds
 
 
-def get_cell_character(
-    image_id: int,
-    y: int,
-    x: int,
-    include_color: bool = False,
+def write_terminal_cmds(cmds: List[bytes]):
+    payload_bytes = sum(map(len, cmds))
+    with measure_latency("transmit", payload_bytes=payload_bytes), open_tty() as tty:
+        for cmd in cmds:
+            tty.write(cmd)
+    count_metric("tty_bytes", payload_bytes)
+
+
+def write_temp_file(data: bytes):
+    # The terminal only deletes temporary files which contain this string
+    with tempfile.NamedTemporaryFile(
+        prefix="tty-graphics-protocol-", delete=False
+    ) as f:
+        f.write(data)
+        return f.name
+
+
+def write_shared_memory(data: bytes):
+    name = f"tty-graphics-protocol-{uuid4()}"
+    fd = os.open(f"/dev/shm/{name}", os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return f"/{name}"
+
+
+def write_image_data(
+    control_data: Dict[str, Union[str, int]], image_data: ImageData, medium: str
 ):
+    if medium == "direct":
+        return write_chunked(control_data, image_data.data)
+
+    if medium == "file" and image_data.source_path:
+        # The terminal resolves relative paths against its own working
+        # directory, which isn't necessarily the same as WeeChat's
+        medium_key, location = "f", os.path.abspath(image_data.source_path)
+    elif medium == "shared_memory":
+        medium_key, location = "s", write_shared_memory(image_data.data)
+    else:
+        medium_key, location = "t", write_temp_file(image_data.data)
+
+    control_data = {**control_data, "t": medium_key, "S": len(image_data.data)}
+    cmds = write_chunked(control_data, location.encode())
+    # Temporary files and shared memory are deleted by the terminal after
+    # reading them, so those commands can't be sent again
+    return cmds if medium_key == "f" else []
+
+
+@lru_cache(maxsize=1024)
+def get_placeholder_lines(image_id: int, rows: int, columns: int) -> Tuple[str, ...]:
     image_id_upper = image_id >> 24
     image_id_lower = image_id & 0xFF
-    color = weechat.color(str(image_id_lower)) if include_color else ""
-    y_char = rowcolumn_diacritics_chars[y]
-    x_char = rowcolumn_diacritics_chars[x]
+    color = weechat.color(str(image_id_lower))
     id_char = rowcolumn_diacritics_chars[image_id_upper]
-    return f"{color}\U0010eeee{y_char}{x_char}{id_char}"
-
-
+    # Each cell is the placeholder character followed by the row, column and
+    # image id diacritics, so join the column and id diacritics of all cells
+    # with the placeholder and row diacritic in between
+    column_chars = [x_char + id_char for x_char in rowcolumn_diacritics_chars[:columns]]
+    lines: List[str] = []
+    for y_char in rowcolumn_diacritics_chars[:rows]:
+        cell_start = PLACEHOLDER_CHAR + y_char
+        lines.append(color + cell_start + cell_start.join(column_chars))
+    return tuple(lines)
+
+
+@background_job
 def create_and_send_image_to_terminal_bg(data_serialized: str) -> str:
-    try:
-        data: ImageCreateData = pickle.loads(b64decode(data_serialized))
-        image_data = load_image_data(data.path)
-
-        if data.image_placement:
-            image_placement = data.image_placement
+    data: ImageCreateData = pickle.loads(b64decode(data_serialized))
+    with collect_job_metrics(
+        "preview_image" if data.preview else "create_image",
+        str(data.uuid),
+        data.send_options.job_trace_path,
+        data.send_options.job_profile_path,
+        path=data.path,
+    ) as job_metrics:
+        try:
+            result: ImageCreateFinished = create_image_placement_bg(data)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            result = e
+    return write_background_result((result, job_metrics))
+
+
+def create_image_placement_bg(data: ImageCreateData):
+
+    if data.image_placement:
+        image_placement = data.image_placement
+    else:
+        image_width, image_height = get_image_size(data.path)
+        cell_width = data.send_options.cell_width or DEFAULT_CELL_WIDTH
+        cell_height = data.send_options.cell_height or DEFAULT_CELL_HEIGHT
+        image_columns = image_width / cell_width
+        image_rows = image_height / cell_height
+
+        if not data.columns:
+            rows = data.rows or 5
+            columns = rows / image_rows * image_columns
         else:
-            image_columns = (
-                image_data.width / data.terminal_size.width * data.terminal_size.columns
-            )
-            image_rows = (
-                image_data.height / data.terminal_size.height * data.terminal_size.rows
-            )
-
-            if not data.columns:
-                rows = data.rows or 5
-                columns = rows / image_rows * image_columns
-            else:
-                columns = data.columns
-                rows = data.rows or columns / image_columns * image_rows
+            columns = data.columns
+            rows = data.rows or columns / image_columns * image_rows
 
-            image_placement = ImagePlacement(
-                data.path, data.image_id, round(columns), round(rows)
-            )
+        image_placement = ImagePlacement(
+            data.path, data.image_id, round(columns), round(rows)
+        )
 
-        send_image_to_terminal(image_placement, image_data)
+    if data.preview:
+        send_image_preview_to_terminal(image_placement, data.send_options)
+    else:
+        send_image_to_terminal(image_placement, data.send_options)
 
-        return b64encode(pickle.dumps(image_placement)).decode("ascii")
-    except Exception as e:  # pylint: disable=broad-exception-caught
-        return b64encode(pickle.dumps(e)).decode("ascii")
+    return image_placement
 
 
 def create_and_send_image_to_terminal_bg_finished_cb(
     data_serialized: str, command: str, return_code: int, out_chunk: str, err_chunk: str
 ) -> int:
+    data: ImageCreateData = pickle.loads(b64decode(data_serialized))
     try:
-        data: ImageCreateData = pickle.loads(b64decode(data_serialized))
         out_key = f"{str(data.uuid)}_out"
         err_key = f"{str(data.uuid)}_err"
         string_buffers[out_key].write(out_chunk)
@@ -178,30 +435,109 @@ def create_and_send_image_to_terminal_bg_finished_cb(
         image_placement_was_returned = data.image_placement is not None
 
         if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR or return_code > 0 or err:
+            remove_background_result(out)
             error = RuntimeError(f"return_code={return_code}, err='{err}'")
+            if not image_placement_was_returned:
+                free_image_id(data.image_id)
             data.callback(data.callback_data, error, image_placement_was_returned)
             return weechat.WEECHAT_RC_OK
 
-        result: ImageCreateFinished = pickle.loads(b64decode(out))
+        result: ImageCreateFinished
+        job_metrics: Metrics
+        result, job_metrics = read_background_result(out)
+        merge_metrics(job_metrics)
+        if isinstance(result, Exception) and not image_placement_was_returned:
+            free_image_id(data.image_id)
+        if isinstance(result, ImagePlacement):
+            elapsed = time.monotonic() - data.queued_time
+            image_create_burst.bytes_sent += sum(map(len, result.terminal_cmds))
+            if data.preview:
+                image_create_burst.first_pixel_seconds += elapsed
+                queue_full_image_after_preview(data, result)
+            else:
+                image_create_burst.images_created += 1
+                image_create_burst.full_image_seconds += elapsed
+                if not data.previewed:
+                    image_create_burst.first_pixel_seconds += elapsed
         data.callback(data.callback_data, result, image_placement_was_returned)
     finally:
         if return_code != -1:
-            image_create_queue.pop(0)
-            start_image_create_job(True)
+            image_create_jobs.pop(data.uuid, None)
+            start_image_create_jobs()
     return weechat.WEECHAT_RC_OK
 
 
-def start_image_create_job(prev_job_finished: bool):
-    if image_create_queue and prev_job_finished or len(image_create_queue) == 1:
-        data_serialized = b64encode(pickle.dumps(image_create_queue[0])).decode("ascii")
-        weechat.hook_process(
-            "func:" + get_callback_name(create_and_send_image_to_terminal_bg),
+def report_image_create_burst():
+    elapsed = time.monotonic() - image_create_burst.start_time
+    images_created = image_create_burst.images_created
+    if images_created > 1 and elapsed > 0:
+        print_info(
+            f"created {images_created} images in {elapsed:.2f}s "
+            f"({images_created / elapsed:.1f} images/s, "
+            f"{image_create_burst.bytes_sent / elapsed / 1024 / 1024:.2f} MiB/s), "
+            "average time to first pixel "
+            f"{image_create_burst.first_pixel_seconds / images_created * 1000:.0f}ms, "
+            "to full image "
+            f"{image_create_burst.full_image_seconds / images_created * 1000:.0f}ms"
+        )
+
+
+def start_image_create_jobs():
+    if not image_create_queue and not image_create_jobs:
+        if image_create_burst.start_time:
+            if config_get_bool("report_burst_throughput"):
+                report_image_create_burst()
+            image_create_burst.start_time = 0.0
+            image_create_burst.images_created = 0
+            image_create_burst.bytes_sent = 0
+            image_create_burst.first_pixel_seconds = 0.0
+            image_create_burst.full_image_seconds = 0.0
+        return
+
+    if not image_create_burst.start_time:
+        image_create_burst.start_time = time.monotonic()
+
+    import_pillow()
+    max_jobs = max(1, config_get_int("max_image_create_jobs"))
+    while image_create_queue and len(image_create_jobs) < max_jobs:
+        image_create_data = image_create_queue.pop(0)
+        image_create_jobs[image_create_data.uuid] = image_create_data
+        record_latency(
+            "queue_wait", time.monotonic() - image_create_data.wait_start_time
+        )
+        data_serialized = b64encode(pickle.dumps(image_create_data)).decode("ascii")
+        run_in_background(
+            create_and_send_image_to_terminal_bg,
             60000,
-            get_callback_name(create_and_send_image_to_terminal_bg_finished_cb),
+            create_and_send_image_to_terminal_bg_finished_cb,
             data_serialized,
         )
 
 
+def queue_full_image_after_preview(
+    data: ImageCreateData, preview_placement: ImagePlacement
+):
+    # The full image is sent to the same image id, which replaces the
+    # preview. It's queued last, so the previews of other images are shown
+    # before any full images.
+    image_placement = ImagePlacement(
+        preview_placement.path,
+        preview_placement.image_id,
+        preview_placement.columns,
+        preview_placement.rows,
+    )
+    image_create_queue.append(
+        replace(
+            data,
+            image_placement=image_placement,
+            uuid=uuid4(),
+            preview=False,
+            previewed=True,
+            wait_start_time=time.monotonic(),
+        )
+    )
+
+
 def create_and_send_image_to_terminal(
     image_path: str,
     columns: Optional[int],
@@ -209,7 +545,7 @@ def create_and_send_image_to_terminal(
     callback: Callable[[str, ImageCreateFinished, bool], None],
     callback_data: str,
 ):
-    image_id = get_random_image_id()
+    image_id = allocate_image_id()
     if columns and rows:
         image_placement = ImagePlacement(image_path, image_id, columns, rows)
     else:
@@ -220,46 +556,216 @@ def create_and_send_image_to_terminal(
         image_id,
         columns,
         rows,
-        get_terminal_size(),
+        get_image_send_options(),
         image_placement,
         callback,
         callback_data,
     )
-    image_create_queue.append(image_create_data)
-    start_image_create_job(False)
+    if image_create_data.send_options.preview_size:
+        # Previews are sent before the images waiting in the queue
+        image_create_data.preview = True
+        index = next(
+            (i for i, data in enumerate(image_create_queue) if not data.preview),
+            len(image_create_queue),
+        )
+        image_create_queue.insert(index, image_create_data)
+    else:
+        image_create_queue.append(image_create_data)
+    start_image_create_jobs()
     return image_placement
 
 
 def send_image_to_terminal(
-    image_placement: ImagePlacement, image_data: Optional[ImageData] = None
+    image_placement: ImagePlacement,
+    send_options: ImageSendOptions,
+    image_data: Optional[ImageData] = None,
 ):
     if image_placement.terminal_cmds:
-        with open(os.ctermid(), "wb") as tty:
-            for cmd in image_placement.terminal_cmds:
-                tty.write(cmd)
-                tty.flush()
-    else:
-        control_data = {
-            "a": "T",
+        write_terminal_cmds(image_placement.terminal_cmds)
+        return
+
+    max_size = get_image_max_size(image_placement, send_options)
+    payload_cache_key = None
+    if (
+        send_options.payload_cache_max_size > 0
+        and send_options.transmission_medium == "direct"
+    ):
+        payload_cache_key = get_payload_cache_key(
+            image_placement.path,
+            image_placement.columns,
+            image_placement.rows,
+            max_size,
+            send_options.downscale_resample,
+            send_options.transmission_format,
+            send_options.transmission_compression_level,
+            send_options.animation_max_frames,
+            send_options.animation_max_size,
+            is_tmux(),
+        )
+        cmds = read_cached_payload(send_options.payload_cache_path, payload_cache_key)
+        count_metric("payload_cache_hits" if cmds else "payload_cache_misses")
+        if cmds:
+            image_placement.terminal_cmds = set_cmds_image_id(
+                cmds, image_placement.image_id
+            )
+            write_terminal_cmds(image_placement.terminal_cmds)
+            return
+
+    if image_data is None:
+        image_data = load_image_data(
+            image_placement.path,
+            max_size,
+            send_options.downscale_resample,
+            send_options.transmission_format,
+            send_options.transmission_compression_level,
+            send_options.thumbnail_cache_path,
+            send_options.thumbnail_cache_max_size,
+        )
+    control_data: Dict[str, Union[str, int]] = {
+        "a": "T",
+        "q": 2,
+        "f": image_data.format,
+        "U": 1,
+        "c": image_placement.columns,
+        "r": image_placement.rows,
+        "i": image_placement.image_id,
+    }
+    if image_data.format != IMAGE_FORMAT_PNG:
+        control_data["s"] = image_data.width
+        control_data["v"] = image_data.height
+    if image_data.compressed:
+        control_data["o"] = "z"
+    image_placement.terminal_cmds = write_image_data(
+        control_data, image_data, send_options.transmission_medium
+    )
+    if send_options.animation_max_frames > 1:
+        send_animation_frames(image_placement, send_options, max_size)
+
+    if payload_cache_key and image_placement.terminal_cmds:
+        write_cached_payload(
+            send_options.payload_cache_path,
+            payload_cache_key,
+            image_placement.terminal_cmds,
+            send_options.payload_cache_max_size,
+        )
+
+
+def send_image_preview_to_terminal(
+    image_placement: ImagePlacement, send_options: ImageSendOptions
+):
+    # The terminal scales the image to the cells, so a preview of a few
+    # pixels in each direction is enough to show the colors of the image.
+    # Skip the caches, since it's cheap to create.
+    preview_size = send_options.preview_size
+    image_data = load_image_data(
+        image_placement.path,
+        (preview_size, preview_size),
+        send_options.downscale_resample,
+        "raw",
+        1,
+    )
+    preview_send_options = replace(
+        send_options, payload_cache_max_size=0, animation_max_frames=1
+    )
+    send_image_to_terminal(image_placement, preview_send_options, image_data)
+
+
+def send_animation_frames(
+    image_placement: ImagePlacement,
+    send_options: ImageSendOptions,
+    max_size: Optional[Tuple[int, int]],
+):
+    # Each frame is sent as soon as it's encoded, so only one frame is
+    # decoded at a time. The commands are only kept if the first frame's
+    # are, since the frames can't be restored without the image.
+    keep_cmds = bool(image_placement.terminal_cmds)
+    frames = load_animation_frames(
+        image_placement.path,
+        max_size,
+        send_options.downscale_resample,
+        send_options.transmission_format,
+        send_options.transmission_compression_level,
+    )
+    first_frame_gap = 0
+    frame_count = 0
+    frames_size = 0
+    for frame_gap, frame_data in frames:
+        if frame_data is None:
+            first_frame_gap = frame_gap
+            frame_count = 1
+            continue
+        frames_size += len(frame_data.data)
+        if (
+            frame_count >= send_options.animation_max_frames
+            or frames_size > send_options.animation_max_size
+        ):
+            break
+        control_data: Dict[str, Union[str, int]] = {
+            "a": "f",
             "q": 2,
-            "f": 100,
-            "U": 1,
-            "c": image_placement.columns,
-            "r": image_placement.rows,
             "i": image_placement.image_id,
+            "f": frame_data.format,
+            "z": frame_gap,
+        }
+        if frame_data.format != IMAGE_FORMAT_PNG:
+            control_data["s"] = frame_data.width
+            control_data["v"] = frame_data.height
+        if frame_data.compressed:
+            control_data["o"] = "z"
+        cmds = write_image_data(
+            control_data, frame_data, send_options.transmission_medium
+        )
+        if keep_cmds:
+            image_placement.terminal_cmds += cmds
+        frame_count += 1
+    frames.close()
+
+    if frame_count > 1:
+        image_id = image_placement.image_id
+        # Set the gap of the first frame, and loop the animation forever
+        first_frame_control_data: Dict[str, Union[str, int]] = {
+            "a": "a",
+            "q": 2,
+            "i": image_id,
+            "r": 1,
+            "z": first_frame_gap,
+        }
+        run_control_data: Dict[str, Union[str, int]] = {
+            "a": "a",
+            "q": 2,
+            "i": image_id,
+            "s": 3,
+            "v": 1,
         }
-        image_data = load_image_data(image_placement.path)
-        image_placement.terminal_cmds = write_chunked(control_data, image_data.data)
+        cmds = [
+            serialize_gr_command(first_frame_control_data, b""),
+            serialize_gr_command(run_control_data, b""),
+        ]
+        write_terminal_cmds(cmds)
+        if keep_cmds:
+            image_placement.terminal_cmds += cmds
 
 
+@background_job
 def send_images_to_terminal_bg(data_serialized: str):
-    try:
-        data: ImagesSendData = pickle.loads(b64decode(data_serialized))
+    data: ImagesSendData = pickle.loads(b64decode(data_serialized))
+    with collect_job_metrics(
+        "send_images",
+        str(data.uuid),
+        data.send_options.job_trace_path,
+        data.send_options.job_profile_path,
+        paths=[image_placement.path for image_placement in data.image_placements],
+    ) as job_metrics:
+        result: ImagesSendFinished = []
         for image_placement in data.image_placements:
-            send_image_to_terminal(image_placement)
-        return b64encode(pickle.dumps(None)).decode("ascii")
-    except Exception as e:  # pylint: disable=broad-exception-caught
-        return b64encode(pickle.dumps(e)).decode("ascii")
+            # Placements without terminal commands are created again from
+            # their file, which may have been removed, so skip the ones which
+            # fail instead of stopping the rest
+            try:
+                send_image_to_terminal(image_placement, data.send_options)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                result.append(f"{image_placement.path}: {e!r}")
+    return write_background_result((result, job_metrics))
 
 
 def send_images_to_terminal_bg_finished_cb(
@@ -282,11 +788,15 @@ def send_images_to_terminal_bg_finished_cb(
     del string_buffers[err_key]
 
     if return_code == weechat.WEECHAT_HOOK_PROCESS_ERROR or return_code > 0 or err:
+        remove_background_result(out)
         error = RuntimeError(f"return_code={return_code}, err='{err}'")
         data.callback(data.callback_data, error)
         return weechat.WEECHAT_RC_OK
 
-    result: ImagesSendFinished = pickle.loads(b64decode(out))
+    result: ImagesSendFinished
+    job_metrics: Metrics
+    result, job_metrics = read_background_result(out)
+    merge_metrics(job_metrics)
     data.callback(data.callback_data, result)
     return weechat.WEECHAT_RC_OK
 
@@ -296,25 +806,26 @@ def send_images_to_terminal(
     callback: Callable[[str, ImagesSendFinished], None],
     callback_data: str,
 ):
+    import_pillow()
     images_send_data = ImagesSendData(
         image_placements,
+        get_image_send_options(),
         callback,
         callback_data,
     )
     data_serialized = b64encode(pickle.dumps(images_send_data)).decode("ascii")
 
-    weechat.hook_process(
-        "func:" + get_callback_name(send_images_to_terminal_bg),
+    run_in_background(
+        send_images_to_terminal_bg,
         60000,
-        get_callback_name(send_images_to_terminal_bg_finished_cb),
+        send_images_to_terminal_bg_finished_cb,
         data_serialized,
     )
 
 
 def display_image(buffer: str, image_placement: ImagePlacement):
-    for y in range(image_placement.rows):
-        chars = [
-            get_cell_character(image_placement.image_id, y, x, include_color=x == 0)
-            for x in range(image_placement.columns)
-        ]
-        weechat.prnt(buffer, "".join(chars))
+    lines = get_placeholder_lines(
+        image_placement.image_id, image_placement.rows, image_placement.columns
+    )
+    for line in lines:
+        weechat.prnt(buffer, line)
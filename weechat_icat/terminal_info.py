@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import array
+import fcntl
+import os
+import re
+import select
+import termios
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import weechat
+
+from weechat_icat.log import print_error
+from weechat_icat.util import get_callback_name
+
+# Used when the pixel size of the cells can't be determined
+DEFAULT_CELL_WIDTH = 10
+DEFAULT_CELL_HEIGHT = 20
+
+
+@dataclass
+class TerminalSize:
+    rows: int
+    columns: int
+    width: int
+    height: int
+
+
+@dataclass
+class TerminalInfo:
+    size: TerminalSize
+    # 0 if unknown
+    cell_width: float
+    cell_height: float
+    tmux: bool
+    local: bool
+    # None if the terminal didn't reply to the query
+    supports_graphics: Optional[bool]
+    # Whether unicode placeholders can be used; there's no query for this,
+    # so it's assumed to be supported if the graphics protocol is
+    supports_placeholders: Optional[bool]
+
+
+terminal_info = TerminalInfo(TerminalSize(0, 0, 0, 0), 0, 0, False, True, None, None)
+
+
+def get_terminal_size():
+    buf = array.array("H", [0, 0, 0, 0])
+    fcntl.ioctl(1, termios.TIOCGWINSZ, buf)
+    return TerminalSize(*buf)
+
+
+def wrap_tmux_passthrough(sequence: bytes):
+    if not terminal_info.tmux:
+        return sequence
+    return b"\033Ptmux;" + sequence.replace(b"\033", b"\033\033") + b"\033\\"
+
+
+def query_terminal(query: bytes, timeout: float = 0.5):
+    # This is done synchronously, so WeeChat doesn't read the reply as input.
+    # The primary device attributes are requested after the query since all
+    # terminals reply to that, so we know when to stop waiting for a reply.
+    response = b""
+    with open(os.ctermid(), "r+b", buffering=0) as tty:
+        tty.write(query + b"\033[c")
+        deadline = time.monotonic() + timeout
+        while not re.search(rb"\033\[\?[\d;]*c", response):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([tty], [], [], remaining)
+            if not readable:
+                break
+            response += os.read(tty.fileno(), 1024)
+    return response
+
+
+def query_cell_size(size: TerminalSize):
+    response = query_terminal(b"\033[16t\033[14t")
+    cell_size = re.search(rb"\033\[6;(\d+);(\d+)t", response)
+    if cell_size:
+        return float(cell_size.group(2)), float(cell_size.group(1))
+    text_area_size = re.search(rb"\033\[4;(\d+);(\d+)t", response)
+    if text_area_size and size.columns and size.rows:
+        return (
+            int(text_area_size.group(2)) / size.columns,
+            int(text_area_size.group(1)) / size.rows,
+        )
+    return 0.0, 0.0
+
+
+def query_graphics_support() -> Optional[bool]:
+    query = wrap_tmux_passthrough(b"\033_Gi=31,s=1,v=1,a=q,t=d,f=24;AAAA\033\\")
+    response = query_terminal(query)
+    if b"\033_Gi=31;" in response:
+        return b"\033_Gi=31;OK" in response
+    # tmux doesn't always pass the reply through, so we can only tell that
+    # it's unsupported when not using tmux
+    if re.search(rb"\033\[\?[\d;]*c", response) and not terminal_info.tmux:
+        return False
+    return None
+
+
+def probe_terminal_size():
+    size = get_terminal_size()
+    terminal_info.size = size
+    if size.width and size.height and size.columns and size.rows:
+        terminal_info.cell_width = size.width / size.columns
+        terminal_info.cell_height = size.height / size.rows
+    else:
+        # Some multiplexers don't report the pixel size
+        try:
+            cell_width, cell_height = query_cell_size(size)
+        except OSError:
+            cell_width, cell_height = 0.0, 0.0
+        terminal_info.cell_width = cell_width
+        terminal_info.cell_height = cell_height
+
+
+def probe_terminal_info():
+    env = os.environ
+    terminal_info.tmux = bool(env.get("TMUX"))
+    # The terminal can't read our files if we're running over ssh, and with
+    # tmux the client may be on a different host than the server
+    remote_env_vars = ["SSH_CONNECTION", "SSH_CLIENT", "SSH_TTY", "TMUX"]
+    terminal_info.local = not any(env.get(env_var) for env_var in remote_env_vars)
+
+    probe_terminal_size()
+
+    try:
+        terminal_info.supports_graphics = query_graphics_support()
+    except OSError:
+        terminal_info.supports_graphics = None
+    terminal_info.supports_placeholders = terminal_info.supports_graphics
+    if terminal_info.supports_graphics is False:
+        print_error("the terminal doesn't support the kitty graphics protocol")
+
+
+def terminal_resized_cb(data: str, signal: str, signal_data: str) -> int:
+    probe_terminal_size()
+    return weechat.WEECHAT_RC_OK
+
+
+def init_terminal_info():
+    probe_terminal_info()
+    weechat.hook_signal("signal_sigwinch", get_callback_name(terminal_resized_cb), "")
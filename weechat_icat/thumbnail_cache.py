@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import os
+import pickle
+from typing import TYPE_CHECKING, Optional, Tuple
+
+from weechat_icat.download_cache import get_file_hash
+from weechat_icat.metrics import count_metric
+from weechat_icat.payload_cache import evict_cache_dir
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# When the original has to be decoded, a thumbnail with at least this size on
+# the longest side is saved too, so later sizes can be created from it
+THUMBNAIL_BASE_SIZE = 1024
+
+
+def get_thumbnail_size(original_size: Tuple[int, int], level: int):
+    width, height = original_size
+    return -(-width // 2**level), -(-height // 2**level)
+
+
+def get_thumbnail_level(
+    original_size: Tuple[int, int], target_size: Tuple[int, int]
+) -> int:
+    # Thumbnails are the original image reduced by powers of two, and the
+    # level is the exponent of the largest reduction which isn't smaller
+    # than the target size. Reducing stops at 1x1 pixels, since the size
+    # doesn't get any smaller after that.
+    level = 0
+    while True:
+        size = get_thumbnail_size(original_size, level)
+        width, height = get_thumbnail_size(original_size, level + 1)
+        if width < target_size[0] or height < target_size[1]:
+            return level
+        if (width, height) == size:
+            return level
+        level += 1
+
+
+def get_thumbnail_path(cache_path: str, key: str, level: int):
+    return os.path.join(cache_path, f"{key}-{level}")
+
+
+def read_thumbnail(path: str) -> Optional[Image.Image]:
+    from PIL import Image  # pylint: disable=import-outside-toplevel
+
+    # Thumbnails are stored as raw pixels, since encoding and decoding them
+    # costs more than reading and writing a larger file
+    try:
+        with open(path, "rb") as f:
+            mode, size, data = pickle.load(f)
+        # The modification time is used for evicting the least recently used
+        os.utime(path)
+        return Image.frombytes(mode, size, data)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+
+
+def write_thumbnail(cache_path: str, path: str, im: Image.Image, max_size: int):
+    # Background jobs may run concurrently, so write to a unique file and
+    # replace atomically
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump((im.mode, im.size, im.tobytes()), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    evict_cache_dir(cache_path, max_size)
+
+
+def reduce_image(im: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    # Image.reduce doesn't support all modes
+    if im.mode not in ("L", "LA", "RGB", "RGBA"):
+        has_alpha = "A" in im.mode or "transparency" in im.info
+        with im.convert("RGBA" if has_alpha else "RGB") as im_converted:
+            return reduce_image(im_converted, size)
+    # Rounding down so the result is never smaller than size
+    factor = max(1, min(im.width // size[0], im.height // size[1]))
+    return im.reduce(factor) if factor > 1 else im.copy()
+
+
+def open_image_for_size(
+    path: str,
+    original: Image.Image,
+    target_size: Tuple[int, int],
+    cache_path: str,
+    max_size: int,
+) -> Image.Image:
+    # Returns the smallest thumbnail of the image at path which is at least
+    # target_size, creating it from the nearest larger one if it's not
+    # cached. The caller closes the returned image if it's not original.
+    original_size = original.size
+    level = get_thumbnail_level(original_size, target_size)
+    if level == 0:
+        return original
+
+    key = get_file_hash(path)
+    for source_level in range(level, 0, -1):
+        source = read_thumbnail(get_thumbnail_path(cache_path, key, source_level))
+        if (
+            source
+            and source.width >= target_size[0]
+            and source.height >= target_size[1]
+        ):
+            count_metric("thumbnail_cache_hits")
+            break
+    else:
+        count_metric("thumbnail_cache_misses")
+        width, height = original_size
+        base_target_size = (
+            (min(width, THUMBNAIL_BASE_SIZE), 0)
+            if width >= height
+            else (0, min(height, THUMBNAIL_BASE_SIZE))
+        )
+        source_level = min(level, get_thumbnail_level(original_size, base_target_size))
+        source_size = get_thumbnail_size(original_size, source_level)
+        # Lets JPEG decode directly to a reduced scale
+        original.draft(original.mode, source_size)
+        source = reduce_image(original, source_size)
+        if source_level > 0:
+            source_path = get_thumbnail_path(cache_path, key, source_level)
+            write_thumbnail(cache_path, source_path, source, max_size)
+
+    if source_level == level:
+        return source
+
+    with source:
+        thumbnail = reduce_image(source, get_thumbnail_size(original_size, level))
+    thumbnail_path = get_thumbnail_path(cache_path, key, level)
+    write_thumbnail(cache_path, thumbnail_path, thumbnail, max_size)
+    return thumbnail